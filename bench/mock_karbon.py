@@ -0,0 +1,466 @@
+"""Local stand-in for the Karbon v3 API, used by run_benchmarks.py.
+
+Serves deterministic synthetic Organizations, Invoices (with LineItems and
+Payments), WorkItems, Payments, Timesheets (with TimeEntries), CustomFields
+and CustomFieldValues. Collections honour the parts of OData the scripts
+use ($filter, $orderby, $top, $expand) and are split into pages linked by
+@odata.nextLink. Every response can be delayed by a fixed latency, and a
+share of requests can be answered with 429 to exercise the throttler.
+
+Run on its own to point the scripts at it by hand:
+
+    python bench/mock_karbon.py --port 8765
+    karbon_api_url=http://127.0.0.1:8765 python get_all_invoices.py list
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORK_TYPES = ["Tax Return", "Bookkeeping", "Payroll", "Advisory", "Audit"]
+INVOICE_STATUSES = ["Paid", "AwaitingPayment", "AwaitingPayment", "Draft"]
+PAYMENT_METHODS = ["ACH", "Check", "CreditCard", "Wire"]
+ACCOUNTING_SOFTWARE = ["QuickBooks Online", "QuickBooks Desktop", "Xero", "Sage"]
+ENTITY_TYPES = ["LLC", "S Corp", "C Corp", "Sole Proprietor"]
+
+CUSTOM_FIELDS = [
+    {"Key": "CF-ENTITY-TYPE", "Name": "Entity Type", "Type": "ListSingleSelect", "Options": ENTITY_TYPES},
+    {"Key": "CF-QB-PASSWORD", "Name": "QB Admin Password", "Type": "Text", "Options": []},
+    {"Key": "CF-ACCOUNTING", "Name": "Accounting Software", "Type": "ListSingleSelect",
+     "Options": ACCOUNTING_SOFTWARE},
+    {"Key": "CF-RAS-ID", "Name": "RAS ID", "Type": "Text", "Options": []},
+]
+
+
+def odata_date(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class MockData:
+    """Synthetic Karbon records, generated from `seed` so every run is identical."""
+
+    def __init__(self, orgs=200, invoices=2000, work_items_per_org=5, line_items=3,
+                 payments=1, timesheets=500, time_entries=10, seed=1):
+        rnd = random.Random(seed)
+        start = datetime(2020, 1, 1)
+
+        self.organizations = {}
+        self.custom_field_values = {}
+        for i in range(orgs):
+            key = f"ORG{i:05d}"
+            self.organizations[key] = {
+                "OrganizationKey": key,
+                "FullName": f"Client {i}",
+                "EntityDescription": {"Text": (
+                    f"Admin Password: pw{i:05d}\n"
+                    f"RAS ID: RAS-{i:05d}\n"
+                    f"Accounting Software: {rnd.choice(ACCOUNTING_SOFTWARE)}"
+                )},
+                "BusinessCards": [{"Addresses": [{
+                    "AddressLines": f"{rnd.randint(1, 9999)} Main St",
+                    "City": rnd.choice(["Springfield", "Riverside", "Franklin", "Georgetown"]),
+                    "StateProvinceCounty": rnd.choice(["CA", "NY", "TX", "WA"]),
+                    "ZipCode": f"{rnd.randint(10000, 99999)}"
+                }]}]
+            }
+            # half the orgs start with an Entity Type set; the other fields start empty
+            values = []
+            if i % 2:
+                values.append({"Key": "CF-ENTITY-TYPE", "Name": "Entity Type",
+                               "Type": "ListSingleSelect", "Value": [rnd.choice(ENTITY_TYPES)]})
+            self.custom_field_values[key] = values
+
+        org_keys = list(self.organizations)
+        self.work_items = {}
+        for org_key in org_keys:
+            for j in range(work_items_per_org):
+                key = f"WI-{org_key}-{j}"
+                self.work_items[key] = {
+                    "WorkItemKey": key,
+                    "ClientKey": org_key,
+                    "Title": f"{rnd.choice(WORK_TYPES)} {2020 + j}",
+                    "WorkType": rnd.choice(WORK_TYPES),
+                    "StartDate": odata_date(start + timedelta(days=rnd.randint(0, 1500)))
+                }
+        work_items_by_org = {}
+        for work_item in self.work_items.values():
+            work_items_by_org.setdefault(work_item["ClientKey"], []).append(work_item["WorkItemKey"])
+
+        self.invoices = {}
+        self.payments = {}
+        for i in range(invoices):
+            org_key = rnd.choice(org_keys)
+            invoice_key = f"INV{i:07d}"
+            invoice_date = start + timedelta(days=rnd.randint(0, 1500))
+            items = [{
+                "BillableItemType": rnd.choice(["Entity", "TimeEntry", "Expense"]),
+                "BillableItemEntityKey": rnd.choice(work_items_by_org[org_key]),
+                "Description": f"Services rendered {n + 1}",
+                "Amount": round(rnd.uniform(50, 2500), 2)
+            } for n in range(line_items)]
+            total = round(sum(item["Amount"] for item in items), 2)
+
+            invoice_payments = []
+            for n in range(payments):
+                payment_key = f"PAY{i:07d}-{n}"
+                payment = {
+                    "PaymentKey": payment_key,
+                    "InvoiceKey": invoice_key,
+                    "PaymentDate": odata_date(invoice_date + timedelta(days=rnd.randint(1, 60))),
+                    "Amount": round(total / payments, 2),
+                    "PaymentType": "Payment",
+                    "PaymentMethod": rnd.choice(PAYMENT_METHODS)
+                }
+                self.payments[payment_key] = payment
+                invoice_payments.append({k: v for k, v in payment.items() if k != "PaymentMethod"})
+
+            org = self.organizations[org_key]
+            self.invoices[invoice_key] = {
+                "InvoiceKey": invoice_key,
+                "InvoiceNumber": f"{10000 + i}",
+                "InvoiceDate": odata_date(invoice_date),
+                "PaymentDueDate": odata_date(invoice_date + timedelta(days=30)),
+                "InvoiceTotal": total,
+                "InvoiceStatus": rnd.choice(INVOICE_STATUSES),
+                "Client": {"ClientKey": org_key, "Name": org["FullName"],
+                           "EmailAddress": f"billing{org_key.lower()}@example.com"},
+                "LineItems": items,
+                "Payments": invoice_payments
+            }
+
+        work_item_keys = list(self.work_items)
+        self.timesheets = {}
+        for i in range(timesheets):
+            key = f"TS{i:06d}"
+            sheet_start = start + timedelta(days=7 * (i // 10), hours=i % 10)
+            self.timesheets[key] = {
+                "TimesheetKey": key,
+                "UserKey": f"USER{i % 10}",
+                "StartDate": odata_date(sheet_start),
+                "EndDate": odata_date(sheet_start + timedelta(days=6)),
+                "Status": "Approved",
+                "TimeEntries": [{
+                    "TimeEntryKey": f"TE{i:06d}-{n}",
+                    "Date": odata_date(sheet_start + timedelta(days=n % 5)),
+                    "Minutes": rnd.choice([15, 30, 60, 90, 120]),
+                    "WorkItemKey": rnd.choice(work_item_keys),
+                    "Description": "Worked on client file",
+                    "TaskTypeName": rnd.choice(["Prep", "Review", "Admin"])
+                } for n in range(time_entries)]
+            }
+
+    def collection(self, name):
+        return {
+            "Invoices": self.invoices,
+            "Organizations": self.organizations,
+            "WorkItems": self.work_items,
+            "Payments": self.payments,
+            "Timesheets": self.timesheets,
+        }.get(name)
+
+
+# --- just enough OData $filter for the queries the scripts send ---
+
+_TOKEN = re.compile(r"\s*(?:(?P<str>'(?:[^']|'')*')|(?P<punct>[(),])|(?P<word>[^\s(),']+))")
+
+
+def _tokenize(text):
+    tokens, pos = [], 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if not match:
+            raise ValueError(f"cannot parse $filter at: {text[pos:]}")
+        if match.group("str"):
+            tokens.append(("value", match.group("str")[1:-1].replace("''", "'")))
+        elif match.group("punct"):
+            tokens.append((match.group("punct"), None))
+        else:
+            tokens.append(("word", match.group("word")))
+        pos = match.end()
+    return tokens
+
+
+class _FilterParser:
+    """expr := term ('or' term)*; term := factor ('and' factor)*;
+    factor := '(' expr ')' | field op literal | field 'in' '(' literal, ... ')'"""
+
+    OPS = {
+        "eq": lambda a, b: a == b, "ne": lambda a, b: a != b,
+        "gt": lambda a, b: a is not None and a > b, "ge": lambda a, b: a is not None and a >= b,
+        "lt": lambda a, b: a is not None and a < b, "le": lambda a, b: a is not None and a <= b,
+    }
+
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def parse(self):
+        predicate = self._expr()
+        if self.pos != len(self.tokens):
+            raise ValueError("trailing tokens in $filter")
+        return predicate
+
+    def _peek_word(self):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][0] == "word":
+            return self.tokens[self.pos][1].lower()
+        return None
+
+    def _take(self, kind):
+        token = self.tokens[self.pos]
+        if token[0] != kind:
+            raise ValueError(f"expected {kind} in $filter, got {token}")
+        self.pos += 1
+        return token[1]
+
+    def _expr(self):
+        terms = [self._term()]
+        while self._peek_word() == "or":
+            self.pos += 1
+            terms.append(self._term())
+        return terms[0] if len(terms) == 1 else (lambda r: any(t(r) for t in terms))
+
+    def _term(self):
+        factors = [self._factor()]
+        while self._peek_word() == "and":
+            self.pos += 1
+            factors.append(self._factor())
+        return factors[0] if len(factors) == 1 else (lambda r: all(f(r) for f in factors))
+
+    def _literal(self):
+        kind, value = self.tokens[self.pos]
+        self.pos += 1
+        if kind == "value":
+            return value
+        if value == "null":
+            return None
+        # unquoted literals are numbers or datetimes, which compare as ISO text
+        return float(value) if re.fullmatch(r"-?\d+(\.\d+)?", value) else value
+
+    def _factor(self):
+        if self.tokens[self.pos][0] == "(":
+            self.pos += 1
+            predicate = self._expr()
+            self._take(")")
+            return predicate
+
+        field = self._take("word")
+        op = self._take("word").lower()
+        if op == "in":
+            self._take("(")
+            values = {self._literal()}
+            while self.tokens[self.pos][0] == ",":
+                self.pos += 1
+                values.add(self._literal())
+            self._take(")")
+            return lambda r: r.get(field) in values
+        compare = self.OPS[op]
+        value = self._literal()
+        return lambda r: compare(r.get(field), value)
+
+
+def parse_filter(text):
+    return _FilterParser(text).parse()
+
+
+def sort_records(records, orderby):
+    for clause in reversed([c.strip() for c in orderby.split(",") if c.strip()]):
+        field, _, direction = clause.partition(" ")
+        records.sort(key=lambda r: r.get(field) or "", reverse=direction.strip().lower() == "desc")
+    return records
+
+
+class MockKarbonServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the mock data and the injection settings."""
+
+    daemon_threads = True
+
+    def __init__(self, data, port=0, latency=0.0, page_size=100, throttle_rate=0.0,
+                 retry_after=1, seed=1):
+        super().__init__(("127.0.0.1", port), MockKarbonHandler)
+        self.data = data
+        self.latency = latency
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def should_throttle(self):
+        with self._lock:
+            self.requests += 1
+            if self.throttle_rate and self._random.random() < self.throttle_rate:
+                self.throttled += 1
+                return True
+            return False
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class MockKarbonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"           # keep-alive, like the real API
+    # send each response in one write; unbuffered header writes stall on Nagle/delayed ACK
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, status, payload=None, headers=None):
+        body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_throttle():
+            self._send_json(429, {"error": "Too many requests"},
+                            {"Retry-After": str(self.server.retry_after)})
+            return None
+        parts = urllib.parse.urlsplit(self.path)
+        segments = [urllib.parse.unquote(s) for s in parts.path.strip("/").split("/")]
+        if len(segments) < 2 or segments[0] != "v3":
+            self._send_json(404, {"error": "Not found"})
+            return None
+        return segments[1:], dict(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+
+    def do_GET(self):
+        route = self._route()
+        if route is None:
+            return
+        segments, query = route
+        name = segments[0]
+        data = self.server.data
+
+        if name == "CustomFields":
+            self._send_json(200, {"value": CUSTOM_FIELDS})
+            return
+        if name == "CustomFieldValues" and len(segments) == 2:
+            if segments[1] not in data.organizations:
+                self._send_json(404, {"error": "Not found"})
+                return
+            self._send_json(200, {"EntityKey": segments[1],
+                                  "CustomFieldValues": data.custom_field_values[segments[1]]})
+            return
+
+        records = data.collection(name)
+        if records is None:
+            self._send_json(404, {"error": "Not found"})
+            return
+        expand = {e.strip() for e in query.get("$expand", "").split(",") if e.strip()}
+
+        if len(segments) == 2:
+            record = records.get(segments[1])
+            if record is None:
+                self._send_json(404, {"error": "Not found"})
+            else:
+                self._send_json(200, self._shape(name, record, expand))
+            return
+        self._send_page(name, list(records.values()), query, expand)
+
+    def do_PUT(self):
+        # read the body first so a throttled request leaves the connection reusable
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        route = self._route()
+        if route is None:
+            return
+        segments, _ = route
+
+        if segments[0] == "CustomFieldValues" and len(segments) == 2 \
+                and segments[1] in self.server.data.organizations:
+            current = {cf["Name"]: cf for cf in self.server.data.custom_field_values[segments[1]]}
+            for cf in payload.get("CustomFieldValues", []):
+                current[cf["Name"]] = cf
+            self.server.data.custom_field_values[segments[1]] = list(current.values())
+            self._send_json(204)
+            return
+        self._send_json(404, {"error": "Not found"})
+
+    @staticmethod
+    def _shape(name, record, expand):
+        # child collections are only included when asked for with $expand
+        hidden = {
+            "Invoices": {"LineItems", "Payments"},
+            "Organizations": {"BusinessCards"},
+            "Timesheets": {"TimeEntries"},
+        }.get(name, set()) - expand
+        return {k: v for k, v in record.items() if k not in hidden} if hidden else record
+
+    def _send_page(self, name, records, query, expand):
+        try:
+            if query.get("$filter"):
+                predicate = parse_filter(query["$filter"])
+                records = [r for r in records if predicate(r)]
+        except (ValueError, KeyError, IndexError) as exc:
+            self._send_json(400, {"error": f"Invalid $filter: {exc}"})
+            return
+        if query.get("$orderby"):
+            records = sort_records(records, query["$orderby"])
+
+        # $top caps the whole result; it is served page_size records at a time
+        top = int(query["$top"]) if query.get("$top") else len(records)
+        skip = int(query.get("$skip", 0))
+        end = min(top, len(records))
+        page = records[skip:min(end, skip + self.server.page_size)]
+
+        body = {"value": [self._shape(name, r, expand) for r in page]}
+        if skip + len(page) < end:
+            next_query = dict(query, **{"$skip": str(skip + len(page))})
+            path = urllib.parse.urlsplit(self.path).path
+            body["@odata.nextLink"] = f"{self.server.url}{path}?{urllib.parse.urlencode(next_query)}"
+        self._send_json(200, body)
+
+
+def add_data_arguments(parser):
+    parser.add_argument("--orgs", type=int, default=200, help="synthetic organizations")
+    parser.add_argument("--invoices", type=int, default=2000, help="synthetic invoices")
+    parser.add_argument("--timesheets", type=int, default=500, help="synthetic timesheets")
+    parser.add_argument("--latency", type=float, default=20,
+                        help="milliseconds added to every response")
+    parser.add_argument("--page-size", type=int, default=100,
+                        help="records per page before @odata.nextLink")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="share of requests answered with 429 (0-1)")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Retry-After seconds sent with injected 429s")
+
+
+def build_server(args, port=0):
+    data = MockData(orgs=args.orgs, invoices=args.invoices, timesheets=args.timesheets)
+    return MockKarbonServer(data, port=port, latency=args.latency / 1000,
+                            page_size=args.page_size, throttle_rate=args.throttle_rate,
+                            retry_after=args.retry_after)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock Karbon API on localhost.")
+    add_data_arguments(parser)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = build_server(args, port=args.port)
+    print(f"Mock Karbon API listening on {server.url} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
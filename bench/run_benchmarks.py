@@ -0,0 +1,251 @@
+"""Benchmark the export scripts against the local mock Karbon API.
+
+Starts bench/mock_karbon.py in-process and runs each benchmark in its own
+Python process (so peak RSS is per benchmark) with karbon_api_url pointed
+at the mock. Every benchmark runs in one scratch directory, so caches start
+cold and nothing is written next to the real scripts.
+
+    python bench/run_benchmarks.py
+    python bench/run_benchmarks.py list line-items --latency 50 --throttle-rate 0.02
+    python bench/run_benchmarks.py --save before.json
+    python bench/run_benchmarks.py --baseline before.json     # exit 1 on a regression
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is reported as n/a
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import mock_karbon  # noqa: E402  (lives next to this file)
+
+# name -> description, in the order they run
+BENCHMARKS = {
+    "list": "get_all_invoices list_all_inv",
+    "line-items": "get_all_invoices get_inv_line_items",
+    "payments": "get_all_invoices get_inv_payments",
+    "payments-bulk": "get_all_invoices get_inv_payments_bulk",
+    "timesheets": "get_timesheets save_timesheets_to_csv",
+    "time-entries": "get_client_time_entries, one paged listing",
+    "time-entries-sharded": "get_client_time_entries, StartDate shards",
+    "work-items": "get_work_items for --clients clients",
+    "custom-fields": "update_custom_fields plan + apply from descriptions",
+}
+# these read karbon.db, which the list benchmark writes
+NEEDS_INVOICE_STORE = {"line-items", "payments", "payments-bulk"}
+
+CLIENTS_FILE = "bench_clients.txt"
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+# --- benchmark bodies; each runs in a child process inside the scratch directory ---
+
+def _invoices_module():
+    import get_all_invoices
+    # keep the caches in the scratch directory, and cold
+    get_all_invoices.ORG_CACHE_FILE = os.path.abspath("org_cache.json")
+    get_all_invoices.WORK_ITEM_CACHE_FILE = os.path.abspath("work_item_cache.json")
+    return get_all_invoices
+
+
+def run_benchmark(name, args):
+    if name == "list":
+        _invoices_module().list_all_inv()
+    elif name == "line-items":
+        _invoices_module().get_inv_line_items(workers=args.workers)
+    elif name == "payments":
+        _invoices_module().get_inv_payments(workers=args.workers)
+    elif name == "payments-bulk":
+        _invoices_module().get_inv_payments_bulk()
+    elif name == "timesheets":
+        import get_timesheets
+        get_timesheets.save_timesheets_to_csv(get_timesheets.get_all_timesheets())
+    elif name == "time-entries":
+        import get_client_time_entries
+        get_client_time_entries.save_to_csv(get_client_time_entries.fetch_all_time_entries(),
+                                            "all_time_entries.csv")
+    elif name == "time-entries-sharded":
+        import get_client_time_entries
+        entries = get_client_time_entries.fetch_time_entries_sharded(args.shards, args.workers)
+        get_client_time_entries.save_to_csv(entries, "all_time_entries_sharded.csv")
+    elif name == "work-items":
+        import get_work_items
+        client_keys = get_work_items.read_client_keys(CLIENTS_FILE)
+        get_work_items.save_work_items_to_csv(
+            get_work_items.get_work_items_for_clients(client_keys, args.workers))
+    elif name == "custom-fields":
+        import update_custom_fields
+        update_custom_fields.registry = update_custom_fields.CustomFieldRegistry(
+            path=os.path.abspath("custom_fields_cache.json"))
+        entries = update_custom_fields.build_plan("description", args.workers)
+        update_custom_fields.apply_plan(entries, args.workers)
+    else:
+        raise ValueError(f"Unknown benchmark: {name}")
+
+
+def run_child(name, args):
+    """Run one benchmark in this process and write its result as JSON."""
+    from karbon_metrics import metrics
+
+    with open(f"{name}.log", "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        started = time.perf_counter()
+        run_benchmark(name, args)
+        wall = time.perf_counter() - started
+
+    records = metrics.records
+    result = {
+        "name": name,
+        "wall": wall,
+        "requests": len(records),
+        "req_per_s": len(records) / wall if wall else 0.0,
+        "retries": sum(r.retries for r in records),
+        "errors": sum(1 for r in records if r.status is None or r.status >= 400),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    with open(args.result, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+
+# --- parent: mock server, scratch directory, report ---
+
+def child_command(name, args, result_path):
+    return [sys.executable, os.path.abspath(__file__), name, "--child", "--result", result_path,
+            "--workers", str(args.workers), "--shards", str(args.shards)]
+
+
+def spawn(name, args, server, workdir):
+    env = dict(os.environ,
+               karbon_api_url=server.url,
+               bearer_token="Bearer benchmark",
+               access_key="benchmark",
+               karbon_rate_limit=str(args.rate_limit),
+               max_workers=str(args.workers))
+    result_path = os.path.join(workdir, f"{name}.result.json")
+    proc = subprocess.run(child_command(name, args, result_path), cwd=workdir, env=env)
+    if proc.returncode != 0:
+        print(f"{name}: failed with exit code {proc.returncode} (see {workdir}/{name}.log)")
+        return None
+    with open(result_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def prepare_workdir(workdir, data, clients):
+    with open(os.path.join(workdir, "organizations.csv"), "w", encoding="utf-8") as f:
+        f.write("Key,Name\n")
+        for key, org in data.organizations.items():
+            f.write(f"{key},{org['FullName']}\n")
+    with open(os.path.join(workdir, CLIENTS_FILE), "w", encoding="utf-8") as f:
+        f.write("\n".join(list(data.organizations)[:clients]) + "\n")
+
+
+def print_results(results, baseline=None, tolerance=0.1):
+    """Print the results table; returns the names of benchmarks that regressed."""
+    regressions = []
+    print(f"\n{'benchmark':<22}{'wall s':>9}{'requests':>10}{'req/s':>9}"
+          f"{'retries':>9}{'errors':>8}{'peak MB':>9}  vs baseline")
+    for result in results:
+        change = ""
+        before = (baseline or {}).get(result["name"])
+        if before and before["wall"]:
+            ratio = result["wall"] / before["wall"] - 1
+            change = f"{ratio:+.0%} wall"
+            if ratio > tolerance:
+                change += "  REGRESSION"
+                regressions.append(result["name"])
+        peak = result["peak_rss_mb"]
+        peak = f"{peak:>9.1f}" if peak is not None else f"{'n/a':>9}"
+        print(f"{result['name']:<22}{result['wall']:>9.2f}{result['requests']:>10}"
+              f"{result['req_per_s']:>9.1f}{result['retries']:>9}{result['errors']:>8}"
+              f"{peak}  {change}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Karbon export scripts against a local mock API.")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    mock_karbon.add_data_arguments(parser)
+    parser.add_argument("--workers", type=int, default=8, help="max_workers for the scripts")
+    parser.add_argument("--shards", type=int, default=4, help="shards for time-entries-sharded")
+    parser.add_argument("--clients", type=int, default=50, help="clients for work-items")
+    parser.add_argument("--rate-limit", type=float, default=1000,
+                        help="karbon_rate_limit for the scripts (requests/second)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare wall time with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="wall time increase over the baseline reported as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    if args.child:
+        run_child(args.benchmarks[0], args)
+        return
+
+    names = args.benchmarks or list(BENCHMARKS)
+    names = [n for n in BENCHMARKS if n in names]
+
+    server = mock_karbon.build_server(args)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix="karbon-bench-")
+    prepare_workdir(workdir, server.data, args.clients)
+    print(f"Mock API at {server.url}: {args.invoices} invoices, {args.orgs} orgs, "
+          f"{args.timesheets} timesheets, {args.latency:g}ms latency, page size {args.page_size}, "
+          f"{args.throttle_rate:.0%} throttled. Scratch directory: {workdir}")
+
+    results = []
+    try:
+        if NEEDS_INVOICE_STORE & set(names) and "list" not in names:
+            print("Building the invoice store for the line item / payment benchmarks...")
+            spawn("list", args, server, workdir)
+        for name in names:
+            print(f"Running {name} ({BENCHMARKS[name]})...")
+            result = spawn(name, args, server, workdir)
+            if result:
+                results.append(result)
+    finally:
+        server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {r["name"]: r for r in json.load(f)}
+    regressions = print_results(results, baseline, args.tolerance)
+    print(f"\nMock server handled {server.requests} requests, {server.throttled} answered with 429.")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to '{args.save}'.")
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if regressions or len(results) < len(names):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import csv
+import json
+import math
+import os
+import tempfile
+
+
+def _cell(value):
+    # match pandas' to_csv: missing values are written as empty cells
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return value
+
+
+class CSVStreamWriter:
+    """Write dict rows to a CSV file as they arrive instead of all at the end.
+
+    The header comes from `fieldnames`, or from the first row's keys when
+    none are given. The file is flushed every `flush_every` rows, so a crash
+    loses at most that many rows and memory use does not grow with the
+    export. Rows are dicts, or value sequences in header order passed to
+    `write_values`. Extra keyword arguments are passed to csv.writer.
+    """
+
+    def __init__(self, filename, fieldnames=None, flush_every=500, mode="w", **fmtparams):
+        self.filename = filename
+        self.fieldnames = list(fieldnames) if fieldnames else None
+        self.flush_every = flush_every
+        self.rows_written = 0
+        self._fmtparams = fmtparams
+        self._write_header = mode == "w"
+        self._file = open(filename, mode, newline="", encoding="utf-8")
+        self._writer = None
+        if self.fieldnames:
+            self._start()
+
+    def _start(self):
+        self._writer = csv.writer(self._file, **self._fmtparams)
+        if self._write_header:
+            self._writer.writerow(self.fieldnames)
+
+    def write(self, row):
+        if self._writer is None:
+            self.fieldnames = list(row.keys())
+            self._start()
+        self.write_values([row.get(key) for key in self.fieldnames])
+
+    def write_values(self, values):
+        self._writer.writerow([_cell(value) for value in values])
+        self.rows_written += 1
+        if self.rows_written % self.flush_every == 0:
+            self._file.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        self._file.flush()
+
+    def size(self):
+        """Flush and return the number of bytes written to the file so far."""
+        self._file.flush()
+        return os.fstat(self._file.fileno()).st_size
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def flatten_record(record, prefix=""):
+    """Flatten nested objects into dotted columns, e.g. {"a": {"b": 1}} -> {"a.b": 1}.
+
+    Lists are written as JSON text rather than Python reprs.
+    """
+    flat = {}
+    for key, value in record.items():
+        column = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_record(value, f"{column}."))
+        elif isinstance(value, list):
+            flat[column] = json.dumps(value)
+        else:
+            flat[column] = value
+    return flat
+
+
+class FlatCSVWriter:
+    """Streaming CSV writer for records whose keys differ from row to row.
+
+    Records are flattened and spooled to a temporary file as they arrive,
+    while the union of their columns is collected. Closing the writer writes
+    the final file with the full header, leaving cells blank where a record
+    had no value, so a record with an extra or nested key never stops the
+    export. Columns keep the order they were first seen in, or are sorted
+    with `sort_columns`. An export that raises inside the `with` block
+    leaves the output file untouched.
+    """
+
+    def __init__(self, filename, sort_columns=False, flush_every=500):
+        self.filename = filename
+        self.sort_columns = sort_columns
+        self.flush_every = flush_every
+        self.rows_written = 0
+        self._columns = {}                  # column -> position in spooled rows
+        self._spool = tempfile.NamedTemporaryFile("w", newline="", encoding="utf-8",
+                                                  suffix=".csv", delete=False)
+        self._writer = csv.writer(self._spool)
+
+    @property
+    def fieldnames(self):
+        return sorted(self._columns) if self.sort_columns else list(self._columns)
+
+    def write(self, record):
+        flat = flatten_record(record)
+        for column in flat:
+            if column not in self._columns:
+                self._columns[column] = len(self._columns)
+
+        # spooled rows are written in discovery order and may be shorter than the final header
+        values = [""] * len(self._columns)
+        for column, value in flat.items():
+            values[self._columns[column]] = _cell(value)
+        self._writer.writerow(values)
+
+        self.rows_written += 1
+        if self.rows_written % self.flush_every == 0:
+            self._spool.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self, keep=True):
+        self._spool.close()
+        try:
+            # nothing is written for an export without rows
+            if keep and self.rows_written:
+                self._write_output()
+        finally:
+            os.remove(self._spool.name)
+
+    def _write_output(self):
+        fieldnames = self.fieldnames
+        positions = [self._columns[column] for column in fieldnames]
+        with open(self._spool.name, newline="", encoding="utf-8") as spool, \
+                open(self.filename, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(fieldnames)
+            for values in csv.reader(spool):
+                writer.writerow([values[i] if i < len(values) else "" for i in positions])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # an export that fails part way leaves any previous output file as it was
+        self.close(keep=exc_type is None)
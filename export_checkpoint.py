@@ -0,0 +1,87 @@
+import json
+import os
+
+
+class ExportCheckpoint:
+    """Journal of invoices whose rows are fully written to an export file.
+
+    The first journal line names the output file; every following line
+    records one finished InvoiceKey with its row count and the output
+    file's size once those rows were flushed. A resumed run skips the
+    recorded invoices, cuts the output back to the last recorded size
+    (dropping rows of an invoice that was cut off mid-write) and appends
+    from there.
+    """
+
+    def __init__(self, name):
+        self.path = f"{name}.checkpoint.jsonl"
+        self.completed = set()
+        self.rows_written = 0
+        self.output_filename = None
+        self._journal = None
+
+    def open(self, output_filename, resume=False):
+        """Start or resume a journal and return the output file to write to."""
+        entries = self._load() if resume else None
+        if entries:
+            print(f"Resuming '{self.output_filename}': {len(self.completed)} invoices "
+                  f"({self.rows_written} rows) already exported.")
+            # rewrite the journal so a torn last line from the crash is dropped
+            self._journal = open(self.path, "w", encoding="utf-8")
+            self._append({"output": self.output_filename})
+            for entry in entries:
+                self._append(entry)
+            return self.output_filename
+
+        if resume:
+            print(f"No checkpoint to resume from in '{self.path}', starting from the beginning.")
+        self.output_filename = output_filename
+        self._journal = open(self.path, "w", encoding="utf-8")
+        self._append({"output": output_filename})
+        return output_filename
+
+    @property
+    def resuming(self):
+        return bool(self.completed)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return None
+
+        entries = []
+        with open(self.path, encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break                           # torn last line from a crash
+                if i == 0:
+                    self.output_filename = entry["output"]
+                    continue
+                entries.append(entry)
+
+        if not entries or not os.path.exists(self.output_filename):
+            return None
+
+        for entry in entries:
+            self.completed.add(entry["key"])
+            self.rows_written += entry["rows"]
+
+        # drop anything written after the last finished invoice
+        with open(self.output_filename, "r+b") as f:
+            f.truncate(entries[-1]["offset"])
+        return entries
+
+    def _append(self, entry):
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def record(self, invoice_key, rows, offset):
+        self.completed.add(invoice_key)
+        self.rows_written += rows
+        self._append({"key": invoice_key, "rows": rows, "offset": offset})
+
+    def finish(self):
+        """Close and remove the journal once the export is complete."""
+        self._journal.close()
+        os.remove(self.path)
@@ -1,12 +1,25 @@
-import http.client
+import argparse
+import csv
 import json
 import urllib.parse
 import os
 import sys
-import pandas as pd
+import traceback
 from dotenv import load_dotenv
+from karbon_cache import TTLCache
+from karbon_client import PREFETCH_PAGES, BatchLookup, KarbonClient, odata_string
+from karbon_metrics import metrics
+import invoice_store
+import invoice_analytics
+from invoice_rows import LINE_ITEM_COLUMNS, PAYMENT_COLUMNS, InvoiceRow, LineItemRow, PaymentRow
+from csv_export import CSVStreamWriter
+from export_checkpoint import ExportCheckpoint
 from datetime import datetime
 from datetime import date
+from datetime import timedelta
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import chain
 
 base_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -21,218 +34,391 @@ if not os.getenv("bearer_token") or not os.getenv("access_key"):
     print("Missing bearer_token or access_key in .env")
     sys.exit(1)
 
-
-conn = http.client.HTTPSConnection("api.karbonhq.com")
-payload = ''
-headers = {
-    'Accept': 'application/json',
-    'Authorization': os.getenv("bearer_token"),
-    'AccessKey': os.getenv("access_key")
-}
+api = KarbonClient()
 
 # Get current date
 current_date = datetime.now().date()
 
-def list_all_inv():
-    print("Retrieving invoice list...")
+# Number of invoices fetched concurrently by the line item / payment exports
+MAX_WORKERS = int(os.getenv("max_workers", "8"))
 
-    all_rows = []
-    skip_value = 0
-    seen_invoice_keys = set()
+# Invoices requested per page when listing invoices
+INVOICE_PAGE_SIZE = int(os.getenv("invoice_page_size", "500"))
 
-    while True:
-        conn.request("GET", f"/v3/Invoices?$orderby=InvoiceDate&$top=100&$skip={skip_value}", payload, headers)
-        res = conn.getresponse()
-        data = res.read()
-        inv_list_json_data = json.loads(data)
-        invoices = inv_list_json_data.get("value", [])
+# Client addresses are cached by ClientKey and reused across runs
+ORG_CACHE_FILE = os.path.join(base_path, "org_cache.json")
+ORG_CACHE_TTL = 7 * 24 * 3600  # seconds
+
+# Work item titles/types are cached by WorkItemKey and looked up in batches
+WORK_ITEM_CACHE_FILE = os.path.join(base_path, "work_item_cache.json")
+WORK_ITEM_CACHE_TTL = 7 * 24 * 3600  # seconds
+WORK_ITEM_BATCH_SIZE = 50
+
+# Invoices processed per batch by the line item / payment exports
+EXPORT_CHUNK_SIZE = 200
+
+# Incremental sync keeps its high-water mark and known invoice keys next to invoices.csv
+SYNC_STATE_FILE = "invoice_sync_state.json"
+SYNC_LOOKBACK_DAYS = int(os.getenv("sync_lookback_days", "90"))
+
+# Open invoices older than the lookback window are re-read by key, this many per request
+OPEN_INVOICE_BATCH_SIZE = 50
+
+def fetch_client_address(client_key):
+    org_json_data = api.get_json(f"/v3/Organizations/{client_key}?$expand=BusinessCards", missing_ok=True)
+
+    business_cards = org_json_data.get("BusinessCards", [])
+    if business_cards and business_cards[0].get("Addresses"):
+        address = business_cards[0]["Addresses"][0]
+        return {
+            "Street": address.get("AddressLines", ""),
+            "City": address.get("City", ""),
+            "State": address.get("StateProvinceCounty", ""),
+            "Zip": address.get("ZipCode", "")
+        }
+    return {"Street": "", "City": "", "State": "", "Zip": ""}
 
-        if not invoices:
+def iter_invoices(odata_filter=None, page_size=INVOICE_PAGE_SIZE):
+    # (InvoiceDate, InvoiceKey) is a unique, stable sort key, so each page
+    # starts right after the last invoice seen and pages can never overlap
+    after_last = None
+
+    while True:
+        filters = [f"({f})" for f in (odata_filter, after_last) if f]
+        url = f"/v3/Invoices?$orderby=InvoiceDate,InvoiceKey&$top={page_size}"
+        if filters:
+            url += f"&$filter={' and '.join(filters)}"
+
+        last_invoice = None
+        # follows @odata.nextLink if the server splits the page further
+        for page in api.pages(url):
+            invoices = page.get("value", [])
+            if invoices:
+                last_invoice = invoices[-1]
+            yield from invoices
+
+        # a short page is not the end: the server may clamp $top to a lower maximum,
+        # so keep going until a page comes back empty
+        if last_invoice is None:
             break
 
-        for invoice in invoices:
-            invoice_key = invoice.get("InvoiceKey", "")
-            if invoice_key in seen_invoice_keys:
-                continue
-            seen_invoice_keys.add(invoice_key)
-
-            client = invoice.get("Client", {})
-            client_key = client.get("ClientKey", "")
-
-            # Fetch client info
-            conn.request("GET", f"/v3/Organizations/{client_key}?$expand=BusinessCards", payload, headers)
-            res2 = conn.getresponse()
-            data2 = res2.read()
-            inv_detail_json_data = json.loads(data2)
-
-            business_cards = inv_detail_json_data.get("BusinessCards", [])
-            if business_cards and business_cards[0].get("Addresses"):
-                address = business_cards[0]["Addresses"][0]
-                address_lines = address.get("AddressLines", "")
-                city = address.get("City", "")
-                state = address.get("StateProvinceCounty", "")
-                zipcode = address.get("ZipCode", "")
-            else:
-                address_lines = city = state = zipcode = ""
-
-            row = {
-                "Client": client.get("Name", ""),
-                "Invoice Number": invoice.get("InvoiceNumber", ""),
-                "Invoice Total": invoice.get("InvoiceTotal", ""),
-                "Street": address_lines,
-                "City": city,
-                "State": state,
-                "Zip": zipcode,
-                "Status": invoice.get("InvoiceStatus", ""),
-                "Due Date": invoice.get("PaymentDueDate", "").split("T")[0],
-                "Invoice Date": invoice.get("InvoiceDate", "").split("T")[0],
-                "Invoice Key": invoice_key,
-                "Email Address": client.get("EmailAddress", "")
-            }
-
-            all_rows.append(row)
-            print(f"{row['Invoice Number']}, {row['Client']}")
-
-        skip_value += 100
-
-    # Write to CSV using pandas
-    df = pd.DataFrame(all_rows)
-    df.to_csv("invoices.csv", index=False, encoding="utf-8")
-    print("CSV file 'invoices.csv' has been created.")
-    
-def get_inv_line_items():
-    print("Retrieving line items...")
+        last_key = last_invoice.get("InvoiceKey")
+        if not last_key:
+            raise ValueError(f"Invoice without an InvoiceKey in {url}; cannot page past it.")
+        last_key = odata_string(last_key)
+        last_date = last_invoice.get("InvoiceDate")
+        if last_date:
+            after_last = (f"InvoiceDate gt {last_date} or "
+                          f"(InvoiceDate eq {last_date} and InvoiceKey gt {last_key})")
+        else:
+            # invoices without a date sort first: the rest of them, then every dated one
+            after_last = (f"(InvoiceDate eq null and InvoiceKey gt {last_key}) or "
+                          f"InvoiceDate ne null")
+
+def fetch_invoice(invoice_key):
+    return api.get_json(f"/v3/Invoices/{urllib.parse.quote(invoice_key)}", missing_ok=True)
+
+iter_invoices_by_key = BatchLookup("Invoices", "InvoiceKey", iter_invoices, fetch_invoice,
+                                   batch_size=OPEN_INVOICE_BATCH_SIZE)
+
+def iter_invoice_rows(invoices):
+    org_cache = TTLCache(ORG_CACHE_FILE, ttl=ORG_CACHE_TTL)
+    metrics.register_cache("Organization", org_cache)
+
+    for invoice in invoices:
+        client = invoice.get("Client", {})
+        client_key = client.get("ClientKey", "")
+
+        # Fetch client info (once per organization)
+        address = org_cache.get_or_fetch(client_key, fetch_client_address)
+
+        row = InvoiceRow(
+            client=client.get("Name", ""),
+            number=invoice.get("InvoiceNumber", ""),
+            total=invoice.get("InvoiceTotal", ""),
+            street=address["Street"],
+            city=address["City"],
+            state=address["State"],
+            zip=address["Zip"],
+            status=invoice.get("InvoiceStatus", ""),
+            due_date=invoice.get("PaymentDueDate", "").split("T")[0],
+            invoice_date=invoice.get("InvoiceDate", "").split("T")[0],
+            key=invoice.get("InvoiceKey", ""),
+            email=client.get("EmailAddress", "")
+        )
+
+        print(f"{row.number}, {row.client}")
+        yield row
+
+    org_cache.save()
+    print(org_cache.summary("Organization"))
+
+def load_sync_state():
+    if not os.path.exists(SYNC_STATE_FILE):
+        return None
+    with open(SYNC_STATE_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_sync_state():
+    df = invoice_store.load_invoices(columns=["Invoice Key", "Invoice Date"], parse_dates=False)
+    dates = df["Invoice Date"].dropna()
+    state = {
+        # a future-dated invoice must not move the window past today
+        "high_water_mark": min(dates.max(), date.today().isoformat()) if not dates.empty else None,
+        "invoice_keys": sorted(df["Invoice Key"].dropna()),
+        "synced_at": datetime.now().isoformat(timespec="seconds")
+    }
+    with open(SYNC_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(state, f)
 
-    # Load invoice list with pandas
-    df = pd.read_csv("invoices.csv", encoding="utf-8-sig")
+def list_all_inv():
+    print("Retrieving invoice list...")
 
-    # Prepare list to collect all line items
+    # Rows go straight into the local store as each page arrives
+    with invoice_store.InvoiceWriter() as store:
+        for row in iter_invoice_rows(iter_invoices()):
+            store.write(row)
+
+    # invoices.csv is kept as an export of the store
+    invoice_store.export_csv("invoices.csv")
+    save_sync_state()
+    print(f"Invoice store '{invoice_store.STORE_FILE}' and CSV file 'invoices.csv' have been created "
+          f"with {store.rows_written} invoices.")
+
+def sync_invoices():
+    state = load_sync_state()
+    if not state or not state.get("high_water_mark") or not invoice_store.store_exists():
+        print("No previous sync found, generating a full invoice list instead.")
+        list_all_inv()
+        return
+
+    # Re-read a window before the high-water mark so recent status changes are picked up
+    high_water_mark = min(date.fromisoformat(state["high_water_mark"]), date.today())
+    since = high_water_mark - timedelta(days=SYNC_LOOKBACK_DAYS)
+
+    # Invoices still open in the store but dated before the window are re-read by key,
+    # otherwise one paid after dropping out of the window would stay open forever
+    df = invoice_store.load_invoices(columns=["Invoice Key", "Status", "Invoice Date"], parse_dates=False)
+    older_open = df[(df["Status"] == invoice_analytics.OPEN_STATUS) &
+                    ~(df["Invoice Date"] >= since.isoformat())]["Invoice Key"].tolist()
+    print(f"Retrieving invoices dated on or after {since}, and {len(older_open)} older open invoices...")
+
+    invoices = chain(iter_invoices(f"InvoiceDate ge {since.isoformat()}T00:00:00Z"),
+                     iter_invoices_by_key(older_open))
+    new_rows = list(iter_invoice_rows(invoices))
+    if not new_rows:
+        print("No new or changed invoices.")
+        return
+
+    known_keys = set(state.get("invoice_keys", []))
+    added = sum(1 for row in new_rows if row.key not in known_keys)
+
+    # Replace re-fetched invoices and keep everything else from the last run
+    invoice_store.upsert_invoices(new_rows)
+    invoice_store.export_csv("invoices.csv")
+    save_sync_state()
+    print(f"Synced {len(new_rows)} invoices ({added} new, {len(new_rows) - added} refreshed).")
+
+# quote every field and use the platform line ending, as pandas' to_csv(quoting=1) did
+EXPORT_CSV_FORMAT = {"quoting": csv.QUOTE_ALL, "lineterminator": os.linesep}
+
+def work_item_fields(work_json):
+    return {"Title": work_json.get("Title", ""), "WorkType": work_json.get("WorkType", "")}
+
+def fetch_work_item_json(work_key):
+    return api.get_json(f"/v3/WorkItems/{work_key}", missing_ok=True)
+
+def fetch_work_item(work_key):
+    return work_item_fields(fetch_work_item_json(work_key))
+
+def list_work_items(odata_filter):
+    return api.paginate(f"/v3/WorkItems?$filter={odata_filter}")
+
+lookup_work_items = BatchLookup("WorkItems", "WorkItemKey", list_work_items, fetch_work_item_json,
+                                batch_size=WORK_ITEM_BATCH_SIZE)
+
+def fetch_work_item_batch(work_keys):
+    found = {work_json.get("WorkItemKey"): work_item_fields(work_json)
+             for work_json in lookup_work_items(work_keys)}
+
+    # anything the batch did not return is looked up on its own (the fallback already did)
+    for work_key in work_keys:
+        if work_key not in found:
+            found[work_key] = (fetch_work_item(work_key) if lookup_work_items.batched
+                               else work_item_fields({}))
+    return found
+
+def resolve_work_items(work_keys, work_item_cache, executor):
+    """Look up Title/WorkType for each distinct work key, WORK_ITEM_BATCH_SIZE keys per request."""
+    work_items = {}
+    missing = []
+    for work_key in dict.fromkeys(work_keys):
+        cached = work_item_cache.get(work_key)
+        if cached is None:
+            missing.append(work_key)
+        else:
+            work_items[work_key] = cached
+
+    batches = [missing[i:i + WORK_ITEM_BATCH_SIZE] for i in range(0, len(missing), WORK_ITEM_BATCH_SIZE)]
+    for found in executor.map(fetch_work_item_batch, batches):
+        for work_key, work_item in found.items():
+            work_item_cache.set(work_key, work_item)
+            work_items[work_key] = work_item
+    return work_items
+
+def fetch_invoice_line_items(row):
+    inv_key = row.key.strip()
+    inv_key_encoded = urllib.parse.quote(inv_key)
+    json_data = api.get_json(f"/v3/Invoices/{inv_key_encoded}?$expand=LineItems")
+    return json_data.get("LineItems", [])
+
+def build_line_item_rows(row, line_items, work_items):
     line_item_rows = []
+    for item in line_items:
+        description = item.get("Description", "")
+        line_item_total = item.get("Amount", 0)
+
+        # each row points at the invoice row rather than copying its fields
+        if item.get("BillableItemType", "") in ("Entity", "TimeEntry"):
+            work_key = item.get("BillableItemEntityKey", "")
+            work_item = work_items[work_key]
+            line_item_rows.append(LineItemRow(row, description, line_item_total, work_key,
+                                              work_item["Title"], work_item["WorkType"]))
+        else:
+            line_item_rows.append(LineItemRow(row, description, line_item_total))
 
-    for _, row in df.iterrows():
-        inv_key = str(row["Invoice Key"]).strip()
-        inv_key_encoded = urllib.parse.quote(inv_key)
-        conn.request("GET", f"/v3/Invoices/{inv_key_encoded}?$expand=LineItems", payload, headers)
-        res = conn.getresponse()
-        data = res.read()
-        json_data = json.loads(data.decode("utf-8"))
-
-        line_items = json_data.get("LineItems", [])
-        for item in line_items:
-            billable_item_type = item.get("BillableItemType", "")
-            description = item.get("Description", "")
-            line_item_total = item.get("Amount", 0)
-
-            if billable_item_type in ("Entity", "TimeEntry"):
-                work_key = item.get("BillableItemEntityKey", "")
-                work_url = f"https://app2.karbonhq.com/YtfB1S5FYHG#/work/{work_key}/tasks"
-
-                conn.request("GET", f"/v3/WorkItems/{work_key}", payload, headers)
-                res = conn.getresponse()
-                data = res.read()
-                work_json = json.loads(data.decode("utf-8"))
-                work_title = work_json.get("Title", "")
-                work_type = work_json.get("WorkType", "")
-            else:
-                work_key = ""
-                work_url = ""
-                work_title = ""
-                work_type = ""
-
-            line_item_rows.append({
-                "Invoice Number": row["Invoice Number"],
-                "Client": row["Client"],
-                "Street": row["Street"],
-                "City": row["City"],
-                "State": row["State"],
-                "Zipcode": row["Zip"],
-                "Email": row["Email Address"],
-                "Invoice Total": row["Invoice Total"],
-                "Status": row["Status"],
-                "Due Date": row["Due Date"],
-                "Invoice Date": row["Invoice Date"],
-                "Line Item Description": description,
-                "Line Item Total": line_item_total,
-                "Work Title": work_title,
-                "Work Type": work_type,
-                "Work URL": work_url
-            })
-
-        print(f"Processed invoice {row['Invoice Number']} with {len(line_items)} line items.")
-
-    # Write all line items to CSV using pandas
+    print(f"Processed invoice {row.number} with {len(line_items)} line items.")
+    return line_item_rows
+
+def fetch_line_items_chunk(rows, executor, work_item_cache):
+    # 1. invoice line items, fetched concurrently
+    line_items_per_invoice = list(executor.map(fetch_invoice_line_items, rows))
+
+    # 2. each distinct work item in the chunk, resolved in bulk
+    work_keys = [
+        item.get("BillableItemEntityKey", "")
+        for line_items in line_items_per_invoice
+        for item in line_items
+        if item.get("BillableItemType", "") in ("Entity", "TimeEntry")
+    ]
+    work_items = resolve_work_items(work_keys, work_item_cache, executor)
+
+    # 3. output rows, in invoice order
+    return [build_line_item_rows(row, line_items, work_items)
+            for row, line_items in zip(rows, line_items_per_invoice)]
+
+def export_per_invoice(fetch_chunk, columns, output_filename, checkpoint_name, workers, resume):
+    # Load invoice list from the local store (dates stay as text for the export)
+    invoices = invoice_store.load_invoice_rows()
+
+    checkpoint = ExportCheckpoint(checkpoint_name)
+    output_filename = checkpoint.open(output_filename, resume)
+    todo = [row for row in invoices if row.key.strip() not in checkpoint.completed]
+
+    # invoices are fetched EXPORT_CHUNK_SIZE at a time; results come back in invoice
+    # order, so the output matches a serial run, and each invoice's rows are
+    # written and journaled as soon as its chunk is done
+    mode = "a" if checkpoint.resuming else "w"
+    with metrics.stage_pool(workers) as executor, \
+            CSVStreamWriter(output_filename, columns, mode=mode, **EXPORT_CSV_FORMAT) as writer:
+        for start in range(0, len(todo), EXPORT_CHUNK_SIZE):
+            chunk = todo[start:start + EXPORT_CHUNK_SIZE]
+            for row, rows in zip(chunk, fetch_chunk(chunk, executor)):
+                for child_row in rows:
+                    writer.write_values(child_row.values())
+                checkpoint.record(row.key.strip(), len(rows), writer.size())
+
+    checkpoint.finish()
+    return output_filename
+
+def get_inv_line_items(workers=MAX_WORKERS, resume=False):
+    print("Retrieving line items...")
+
+    work_item_cache = TTLCache(WORK_ITEM_CACHE_FILE, ttl=WORK_ITEM_CACHE_TTL)
+    metrics.register_cache("Work item", work_item_cache)
     output_filename = f"{datetime.today().strftime('%Y-%m-%d')} invoices_line_items.csv"
-    pd.DataFrame(line_item_rows).to_csv(output_filename, index=False, quoting=1, encoding="utf-8")
+    try:
+        output_filename = export_per_invoice(
+            partial(fetch_line_items_chunk, work_item_cache=work_item_cache),
+            LINE_ITEM_COLUMNS, output_filename, "line_items", workers, resume
+        )
+    finally:
+        # keep what was looked up even if the export stops part way
+        work_item_cache.save()
+        print(work_item_cache.summary("Work item"))
     print(f"Spreadsheet '{output_filename}' with line items created.")
 
 def get_additional_payment_info(payment_key):
-    conn.request('GET', f'/v3/Payments/{payment_key}', payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-    payment_json = json.loads(data.decode("utf-8"))
+    payment_json = api.get_json(f'/v3/Payments/{payment_key}', missing_ok=True)
     payment_method = payment_json.get('PaymentMethod', '')
     return payment_method
 
-def get_inv_payments():
-    print("Retrieving payments...")
-
-    # Load invoice data
-    df = pd.read_csv("invoices.csv", encoding="utf-8-sig")
+def build_payment_row(row, payment, payment_method):
+    return PaymentRow(
+        invoice=row,
+        payment_date=payment.get("PaymentDate", ""),
+        amount=payment.get("Amount", ""),
+        payment_type=payment.get("PaymentType", ""),
+        payment_key=payment.get("PaymentKey", ""),
+        payment_method=payment_method
+    )
+
+def fetch_invoice_payments(row):
+    inv_key = row.key.strip()
+    inv_key_encoded = urllib.parse.quote(inv_key)
+    json_data = api.get_json(f"/v3/Invoices/{inv_key_encoded}?$expand=Payments")
 
     payment_rows = []
+    payments = json_data.get("Payments", [])
+    for payment in payments:
+        payment_method = get_additional_payment_info(payment.get("PaymentKey", ""))
+        payment_rows.append(build_payment_row(row, payment, payment_method))
+
+    print(f"Processed invoice {row.number} with {len(payments)} payments.")
+    return payment_rows
 
-    for _, row in df.iterrows():
-        inv_key = str(row["Invoice Key"]).strip()
-        inv_key_encoded = urllib.parse.quote(inv_key)
-        conn.request("GET", f"/v3/Invoices/{inv_key_encoded}?$expand=Payments", payload, headers)
-        res = conn.getresponse()
-        data = res.read()
-        json_data = json.loads(data.decode("utf-8"))
-
-        payments = json_data.get("Payments", [])
-
-        for payment in payments:
-            payment_date = payment.get("PaymentDate", "")
-            payment_amount = payment.get("Amount", "")
-            payment_type = payment.get("PaymentType", "")
-            payment_key = payment.get("PaymentKey", "")
-            payment_method = get_additional_payment_info(payment_key)
-
-            payment_rows.append({
-                "Invoice Number": row["Invoice Number"],
-                "Client": row["Client"],
-                "Street": row["Street"],
-                "City": row["City"],
-                "State": row["State"],
-                "Zipcode": row["Zip"],
-                "Email": row["Email Address"],
-                "Invoice Total": row["Invoice Total"],
-                "Status": row["Status"],
-                "Due Date": row["Due Date"],
-                "Invoice Date": row["Invoice Date"],
-                "Payment Date": payment_date,
-                "Payment Amount": payment_amount,
-                "Payment Type": payment_type,
-                "Payment Key": payment_key,
-                "Payment Method": payment_method
-            })
-
-        print(f"Processed invoice {row['Invoice Number']} with {len(payments)} payments.")
+def get_inv_payments(workers=MAX_WORKERS, resume=False):
+    print("Retrieving payments...")
 
     output_filename = f"{datetime.today().strftime('%Y-%m-%d')} invoice_payments.csv"
-    pd.DataFrame(payment_rows).to_csv(output_filename, index=False, quoting=1, encoding="utf-8")
+    output_filename = export_per_invoice(
+        lambda rows, executor: list(executor.map(fetch_invoice_payments, rows)),
+        PAYMENT_COLUMNS, output_filename, "payments", workers, resume
+    )
     print(f"Spreadsheet '{output_filename}' with payments created.")
 
+def index_payments_by_invoice():
+    # Only the fields used in the export are kept, grouped by InvoiceKey;
+    # each row's invoice is filled in once the invoice list is read
+    payments_by_invoice = {}
+    count = 0
+    for payment in api.paginate("/v3/Payments", prefetch=PREFETCH_PAGES):
+        invoice_key = payment.get("InvoiceKey", "")
+        payments_by_invoice.setdefault(invoice_key, []).append(
+            build_payment_row(None, payment, payment.get("PaymentMethod", ""))
+        )
+        count += 1
+    print(f"Retrieved {count} payments for {len(payments_by_invoice)} invoices.")
+    return payments_by_invoice
+
+def get_inv_payments_bulk():
+    print("Retrieving payments (bulk)...")
+
+    # one paged listing of /v3/Payments replaces the per-invoice and per-payment calls
+    payments_by_invoice = index_payments_by_invoice()
+
+    output_filename = f"{datetime.today().strftime('%Y-%m-%d')} invoice_payments.csv"
+    with CSVStreamWriter(output_filename, PAYMENT_COLUMNS, **EXPORT_CSV_FORMAT) as writer:
+        for row in invoice_store.load_invoice_rows():
+            for payment in payments_by_invoice.get(row.key.strip(), []):
+                payment.invoice = row
+                writer.write_values(payment.values())
+
+    print(f"Spreadsheet '{output_filename}' with {writer.rows_written} payments created.")
+
 def filter_overdue():
-    # Load invoice data
-    df = pd.read_csv("invoices.csv", encoding="utf-8")
-
-    # Filter: status is AwaitingPayment and due date is before today
-    df["Due Date"] = pd.to_datetime(df["Due Date"], errors="coerce")
-    overdue_df = df[
-        (df["Status"] == "AwaitingPayment") &
-        (df["Due Date"].dt.date < date.today())
-    ]
+    # AwaitingPayment invoices due before today
+    overdue_df = invoice_analytics.overdue_invoices(invoice_analytics.load_frame())
 
     # Drop unneeded columns
     overdue_df = overdue_df.drop(columns=["Invoice Key", "Status"])
@@ -244,48 +430,174 @@ def filter_overdue():
 
 def count_clients(year, month):
     # count number of individual clients served by month
-    df = pd.read_csv('invoices.csv')
-
-    # convert 'Invoice Date' to datetime
-    df['Invoice Date'] = pd.to_datetime(df['Invoice Date'])
-
-    # extract month and year from 'Invoice Date'
-    filtered = df[(df['Invoice Date'].dt.year == year) & (df['Invoice Date'].dt.month == month)]
-
-    # get unique clients
-    unique_clients = filtered['Client'].nunique()
+    df = invoice_store.load_invoices(columns=['Client', 'Invoice Date'])
+    unique_clients = invoice_analytics.clients_in_month(df, year, month)
 
     print(f"Number of unique clients served in {month}/{year}: {unique_clients}")
     return unique_clients
 
+def receivables_report():
+    # aging, overdue totals and clients per month from a single load of the invoice list
+    df = invoice_analytics.load_frame()
+
+    aging = invoice_analytics.aging_buckets(df)
+    aging_filename = f"{date.today()} ar_aging.csv"
+    aging.to_csv(aging_filename)
+
+    monthly = invoice_analytics.clients_per_month(df)
+    monthly_filename = f"{date.today()} clients_per_month.csv"
+    monthly.to_csv(monthly_filename)
+
+    totals = aging[invoice_analytics.AGING_COLUMNS].sum()
+    print("Open receivables by days past due: "
+          + ", ".join(f"{label}: {total:,.2f}" for label, total in totals.items()))
+    print(f"Overdue total: {aging['Overdue'].sum():,.2f} across {(aging['Overdue'] > 0).sum()} clients")
+    print(f"Aging report saved to '{aging_filename}', clients per month "
+          f"({len(monthly)} months) to '{monthly_filename}'.")
+
+
+# Stages that read the invoice list wait for whichever of these is being run
+BASE_STAGES = ("list", "sync")
+
+# Stages that write the same output file, so at most one of each group can run
+EXCLUSIVE_STAGES = [("payments", "payments-bulk")]
+
+# stage name -> (menu number, description)
+STAGES = {
+    "list": ("1", "Generate new base invoice list"),
+    "line-items": ("2", "Get line items (slow)"),
+    "overdue": ("3", "Create CSV with overdue invoices"),
+    "payments": ("4", "Get payments for invoices"),
+    "count-clients": ("5", "Count clients served in a month"),
+    "sync": ("6", "Update invoice list with new/changed invoices"),
+    "payments-bulk": ("7", "Get payments for invoices (bulk listing, fewer requests)"),
+    "receivables": ("8", "AR aging and clients served per month (every month at once)")
+}
 
-def main():
-    options = {
-        "1": ("Generate new base invoice list", list_all_inv),
-        "2": ("Get line items (slow)", get_inv_line_items),
-        "3": ("Create CSV with overdue invoices", filter_overdue),
-        "4": ("Get payments for invoices", get_inv_payments),
-        "5": ("Count clients served in a month", count_clients_prompt)
-    }
-
+def build_stage(name, args):
+    if name == "list":
+        return list_all_inv
+    if name == "sync":
+        return sync_invoices
+    if name == "line-items":
+        return partial(get_inv_line_items, workers=args.workers, resume=args.resume)
+    if name == "payments":
+        return partial(get_inv_payments, workers=args.workers, resume=args.resume)
+    if name == "payments-bulk":
+        return get_inv_payments_bulk
+    if name == "overdue":
+        return filter_overdue
+    if name == "count-clients":
+        return partial(count_clients, args.year, args.month)
+    if name == "receivables":
+        return receivables_report
+    raise ValueError(f"Unknown stage: {name}")
+
+def run_stage(name, func):
+    # requests made by the stage, and by its worker pools, are reported under its name
+    with metrics.stage(name):
+        return func()
+
+def run_stages(names, args):
+    """Run the chosen stages as a dependency graph.
+
+    Stages that read the invoice list start once the base list stage (if
+    chosen) has finished; independent stages such as line items and
+    payments then run at the same time. Returns False if any stage failed.
+    """
+    names = list(dict.fromkeys(names))
+    if not names:
+        print("No tasks selected.")
+        return True
+    for group in EXCLUSIVE_STAGES:
+        chosen = [n for n in group if n in names]
+        if len(chosen) > 1:
+            print(f"Choose only one of {' / '.join(chosen)}: they write the same file.")
+            return False
+    base = [n for n in names if n in BASE_STAGES]
+    # list then sync if both are chosen; everything else waits for the base list
+    deps = {n: (base[:base.index(n)] if n in BASE_STAGES else base) for n in names}
+    funcs = {n: build_stage(n, args) for n in names}
+
+    done, failed, running = set(), set(), {}
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        while len(done) + len(failed) < len(names):
+            for name in names:
+                if name in done or name in failed or name in running.values():
+                    continue
+                if any(d in failed for d in deps[name]):
+                    print(f"\nSkipping {name}: a stage it depends on failed")
+                    failed.add(name)
+                elif all(d in done for d in deps[name]):
+                    print(f"\nRunning: {STAGES[name][1]}")
+                    running[executor.submit(run_stage, name, funcs[name])] = name
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception():
+                    print(f"\nStage {name} failed:")
+                    traceback.print_exception(future.exception())
+                    failed.add(name)
+                else:
+                    done.add(name)
+
+    return not failed
+
+def prompt_for_stages(args):
     print("\nAvailable Actions:")
-    for key, (desc, _) in options.items():
-        print(f"{key}. {desc}")
+    for name, (number, desc) in STAGES.items():
+        print(f"{number}. {desc}")
 
     choices = input("\nEnter the numbers of the tasks you want to run (e.g. 1 3 5): ").split()
 
+    by_number = {number: name for name, (number, _) in STAGES.items()}
+    names = []
     for choice in choices:
-        action = options.get(choice)
-        if action:
-            print(f"\nRunning: {action[0]}")
-            action[1]()
+        if choice in by_number:
+            names.append(by_number[choice])
         else:
             print(f"Invalid option: {choice}")
 
-def count_clients_prompt():
-    year = int(input("Enter year (YYYY): "))
-    month = int(input("Enter month (1-12): "))
-    count_clients(year, month)
+    if "count-clients" in names and (args.year is None or args.month is None):
+        args.year = int(input("Enter year (YYYY): "))
+        args.month = int(input("Enter month (1-12): "))
+    return names
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export Karbon invoices, line items and payments.",
+        epilog="Run without stages for the interactive menu. Stages that read the "
+               "invoice list wait for list/sync; the rest run concurrently, e.g. "
+               "'sync line-items payments overdue'."
+    )
+    # checked below: before Python 3.12, choices= rejects an empty nargs="*" list
+    parser.add_argument("stages", nargs="*", metavar="stage",
+                        help=f"stages to run: {', '.join(STAGES)}")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="concurrent requests per line item / payment export")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted line item / payment export")
+    parser.add_argument("--year", type=int, help="year for count-clients")
+    parser.add_argument("--month", type=int, help="month (1-12) for count-clients")
+
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)} (choose from {', '.join(STAGES)})")
+    if "count-clients" in args.stages and (args.year is None or args.month is None):
+        parser.error("count-clients needs --year and --month")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = args.stages or prompt_for_stages(args)
+    succeeded = run_stages(names, args)
+    metrics.finish()
+    if not succeeded:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,61 +1,130 @@
-import requests
+import argparse
 import os
-import csv
+import tempfile
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+import karbon_json
+from karbon_client import PREFETCH_PAGES, KarbonClient
+from karbon_metrics import metrics
+from csv_export import FlatCSVWriter
 
 load_dotenv()
 
-BEARER_TOKEN = os.getenv("bearer_token")
-ACCESS_KEY = os.getenv("access_key")
+TIMESHEETS_URL = "/v3/Timesheets"
+OUTPUT_FILE = "all_time_entries.csv"
+MAX_WORKERS = int(os.getenv("max_workers", "8"))
 
-HEADERS = {
-    "Authorization": BEARER_TOKEN,
-    "AccessKey": ACCESS_KEY,
-    "Accept": "application/json"
-}
+api = KarbonClient()
 
-BASE_URL = "https://api.karbonhq.com/v3/Timesheets"
-OUTPUT_FILE = "all_time_entries.csv"
+def time_entries_from_sheet(sheet):
+    timesheet_key = sheet.get("TimesheetKey")
+    timesheet_date = sheet.get("StartDate")
+    for entry in sheet.get("TimeEntries", []):
+        entry["ParentTimesheetKey"] = timesheet_key
+        entry["TimesheetStartDate"] = timesheet_date
+        # If the entry has a 'Date' field, include it explicitly
+        yield entry
 
 def fetch_all_time_entries():
-    all_entries = []
-    url = f"{BASE_URL}?$expand=TimeEntries"
+    url = f"{TIMESHEETS_URL}?$expand=TimeEntries"
+
+    for sheet in api.paginate(url, prefetch=PREFETCH_PAGES):
+        yield from time_entries_from_sheet(sheet)
 
-    while url:
-        response = requests.get(url, headers=HEADERS)
-        if response.status_code != 200:
-            print(f"Error: {response.status_code} - {response.text}")
-            break
+def parse_odata_date(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
 
-        data = response.json()
-        timesheets = data.get("value", [])
+def timesheet_date_range():
+    # earliest and latest StartDate, one single-row request each
+    first = api.get_json(f"{TIMESHEETS_URL}?$orderby=StartDate&$top=1").get("value", [])
+    last = api.get_json(f"{TIMESHEETS_URL}?$orderby=StartDate desc&$top=1").get("value", [])
+    if not first or not last:
+        return None
+    return parse_odata_date(first[0]["StartDate"]), parse_odata_date(last[0]["StartDate"])
 
-        for sheet in timesheets:
-            timesheet_key = sheet.get("TimesheetKey")
-            timesheet_date = sheet.get("StartDate")
-            for entry in sheet.get("TimeEntries", []):
-                entry["ParentTimesheetKey"] = timesheet_key
-                entry["TimesheetStartDate"] = timesheet_date
-                # If the entry has a 'Date' field, include it explicitly
-                all_entries.append(entry)
+def date_windows(start, end, shards):
+    """Split [start, end] into `shards` back-to-back [from, to) windows."""
+    step = max((end - start) / shards, timedelta(seconds=1))
+    bounds = [start + step * i for i in range(shards)] + [end + timedelta(seconds=1)]
+    return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if lo < hi]
 
-        url = data.get("@odata.nextLink")
+def fetch_shard(window):
+    """Fetch one StartDate window into a temporary JSON lines file and return its path."""
+    lo, hi = window
+    url = (f"{TIMESHEETS_URL}?$expand=TimeEntries&$orderby=StartDate"
+           f"&$filter=StartDate ge {lo:%Y-%m-%dT%H:%M:%SZ} and StartDate lt {hi:%Y-%m-%dT%H:%M:%SZ}")
 
-    return all_entries
+    count = 0
+    spool = tempfile.NamedTemporaryFile("wb", suffix=".jsonl", delete=False)
+    try:
+        with spool:
+            for sheet in api.paginate(url):
+                for entry in time_entries_from_sheet(sheet):
+                    spool.write(karbon_json.dumps(entry) + b"\n")
+                    count += 1
+    except BaseException:
+        os.remove(spool.name)
+        raise
+    print(f"Fetched {count} entries for {lo:%Y-%m-%d} – {hi:%Y-%m-%d}")
+    return spool.name
+
+def fetch_time_entries_sharded(shards, workers=MAX_WORKERS):
+    """Like fetch_all_time_entries, but split by StartDate and fetched concurrently.
+
+    Each window is spooled to a temporary file; windows are yielded in date
+    order as soon as they and every earlier window are done.
+    """
+    date_range = timesheet_date_range()
+    if date_range is None:
+        return
+
+    windows = date_windows(*date_range, shards)
+    print(f"Fetching timesheets {date_range[0]:%Y-%m-%d} – {date_range[1]:%Y-%m-%d} "
+          f"in {len(windows)} shards with {workers} workers...")
+
+    with metrics.stage_pool(workers) as executor:
+        futures = [executor.submit(fetch_shard, window) for window in windows]
+        try:
+            for future in futures:
+                spool_path = future.result()
+                try:
+                    with open(spool_path, "rb") as spool:
+                        for line in spool:
+                            yield karbon_json.loads(line)
+                finally:
+                    os.remove(spool_path)
+        finally:
+            # a shard failed or the caller stopped early: remove the spools never read
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                if not future.cancelled() and future.exception() is None \
+                        and os.path.exists(future.result()):
+                    os.remove(future.result())
 
 def save_to_csv(entries, filename):
-    if not entries:
+    # columns are every key seen in any entry, in the order first seen
+    with FlatCSVWriter(filename) as writer:
+        writer.write_many(entries)
+
+    if not writer.rows_written:
         print("No entries found.")
         return
 
-    fieldnames = list(entries[0].keys())
-    with open(filename, mode="w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(entries)
-
-    print(f"Saved {len(entries)} entries to {filename}")
+    print(f"Saved {writer.rows_written} entries to {filename}")
 
 if __name__ == "__main__":
-    entries = fetch_all_time_entries()
-    save_to_csv(entries, OUTPUT_FILE)
+    parser = argparse.ArgumentParser(description="Export every Karbon time entry to CSV.")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the timesheets into this many StartDate ranges fetched concurrently")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="shards fetched at the same time")
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    args = parser.parse_args()
+
+    if args.shards > 1:
+        entries = fetch_time_entries_sharded(args.shards, args.workers)
+    else:
+        entries = fetch_all_time_entries()
+    save_to_csv(entries, args.output)
+    metrics.finish()
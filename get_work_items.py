@@ -1,51 +1,82 @@
-import requests
+import argparse
 import os
-import csv
 from dotenv import load_dotenv
+from karbon_client import PREFETCH_PAGES, KarbonClient
+from karbon_metrics import metrics
+from csv_export import FlatCSVWriter
 
 # get work items by client
 load_dotenv()
 
-BEARER_TOKEN = os.getenv("bearer_token")
-ACCESS_KEY = os.getenv("access_key")
 CLIENT_KEY = os.getenv("client_key")
-BASE_URL = "https://api.karbonhq.com/v3/WorkItems"
+WORK_ITEMS_URL = "/v3/WorkItems"
+MAX_WORKERS = int(os.getenv("max_workers", "8"))
 
-headers = {
-    'Accept': 'application/json',
-    'Authorization': os.getenv("bearer_token"),
-    'AccessKey': os.getenv("access_key")
-}
+api = KarbonClient()
 
-def get_work_items_by_client(client_key):
-    work_items = []
-    url = f"{BASE_URL}?$filter=ClientKey eq '{client_key}'"
+def get_work_items_by_client(client_key, prefetch=PREFETCH_PAGES):
+    url = f"{WORK_ITEMS_URL}?$filter=ClientKey eq '{client_key}'"
+    return api.paginate(url, prefetch=prefetch)
 
-    while url:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            print(f"Error: {response.status_code} - {response.text}")
-            break
+def get_all_work_items():
+    return api.paginate(WORK_ITEMS_URL, prefetch=PREFETCH_PAGES)
 
-        data = response.json()
-        work_items.extend(data.get("value", []))
-        url = data.get("@odata.nextLink")
+def fetch_client_work_items(client_key):
+    # the pool already overlaps requests; a prefetch thread per client would
+    # only open another connection each
+    return list(get_work_items_by_client(client_key, prefetch=0))
 
-    return work_items
+def get_work_items_for_clients(client_keys, workers=MAX_WORKERS):
+    """Fetch several clients' work items concurrently, yielded client by client.
+
+    Work items that show up under more than one client are yielded once.
+    """
+    seen = set()
+    with metrics.stage_pool(workers) as executor:
+        work_items_per_client = executor.map(fetch_client_work_items, client_keys)
+        for client_key, work_items in zip(client_keys, work_items_per_client):
+            print(f"{client_key}: {len(work_items)} work items")
+            for work_item in work_items:
+                key = work_item.get("WorkItemKey")
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield work_item
+
+def read_client_keys(filename):
+    # one client key per line; blank lines and duplicates are skipped
+    with open(filename, encoding="utf-8-sig") as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip()))
 
 def save_work_items_to_csv(work_items, filename="work_items.csv"):
-    if not work_items:
+    with FlatCSVWriter(filename, sort_columns=True) as writer:
+        writer.write_many(work_items)
+
+    if not writer.rows_written:
         print("No work items found.")
         return
 
-    fieldnames = sorted(work_items[0].keys())
-    with open(filename, mode="w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(work_items)
-
-    print(f"Saved {len(work_items)} work items to {filename}.")
+    print(f"Saved {writer.rows_written} work items to {filename}.")
 
 if __name__ == "__main__":
-    work_items = get_work_items_by_client(CLIENT_KEY)
-    save_work_items_to_csv(work_items)
+    parser = argparse.ArgumentParser(
+        description="Export Karbon work items to CSV (default: client_key from .env)."
+    )
+    clients = parser.add_mutually_exclusive_group()
+    clients.add_argument("--clients", nargs="+", metavar="KEY", help="client keys to export")
+    clients.add_argument("--clients-file", help="file with one client key per line")
+    clients.add_argument("--all", action="store_true", help="export work items for every client")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="clients fetched at the same time")
+    parser.add_argument("--output", default="work_items.csv")
+    args = parser.parse_args()
+
+    if args.all:
+        work_items = get_all_work_items()
+    elif args.clients or args.clients_file:
+        client_keys = list(dict.fromkeys(args.clients)) if args.clients else read_client_keys(args.clients_file)
+        work_items = get_work_items_for_clients(client_keys, args.workers)
+    else:
+        work_items = get_work_items_by_client(CLIENT_KEY)
+    save_work_items_to_csv(work_items, args.output)
+    metrics.finish()
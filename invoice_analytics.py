@@ -0,0 +1,59 @@
+from datetime import date
+
+import pandas as pd
+
+import invoice_store
+
+# open invoices, the only ones that count towards receivables
+OPEN_STATUS = "AwaitingPayment"
+
+# days past due -> aging bucket; invoices not yet due fall in the first bucket
+AGING_BINS = [float("-inf"), 30, 60, 90, float("inf")]
+AGING_LABELS = ["0-30", "31-60", "61-90", "90+"]
+# open invoices without a due date get their own column instead of being dropped
+NO_DUE_DATE = "No due date"
+AGING_COLUMNS = AGING_LABELS + [NO_DUE_DATE]
+
+
+def load_frame():
+    """Load the invoice list once, with typed dates, for every report below."""
+    return invoice_store.load_invoices()
+
+
+def days_past_due(df, as_of=None):
+    as_of = pd.Timestamp(as_of or date.today())
+    return (as_of - df["Due Date"]).dt.days
+
+
+def overdue_invoices(df, as_of=None):
+    """Open invoices whose due date is before `as_of` (default today)."""
+    return df[(df["Status"] == OPEN_STATUS) & (days_past_due(df, as_of) > 0)]
+
+
+def aging_buckets(df, as_of=None):
+    """Open invoice totals per client and aging bucket, plus overdue and open totals.
+
+    One row per client with an open balance, largest overdue total first.
+    """
+    open_df = df[df["Status"] == OPEN_STATUS]
+    days = days_past_due(open_df, as_of)
+    bucket = pd.cut(days.clip(lower=0), AGING_BINS, labels=AGING_LABELS)
+    bucket = bucket.cat.add_categories(NO_DUE_DATE).fillna(NO_DUE_DATE)
+
+    aging = open_df.pivot_table(index="Client", columns=bucket, values="Invoice Total",
+                                aggfunc="sum", fill_value=0, observed=False)
+    aging = aging.reindex(columns=AGING_COLUMNS, fill_value=0)
+    aging.columns = list(AGING_COLUMNS)
+    aging["Overdue"] = open_df["Invoice Total"].where(days > 0, 0).groupby(open_df["Client"]).sum()
+    aging["Open"] = open_df["Invoice Total"].groupby(open_df["Client"]).sum()
+    return aging.sort_values("Overdue", ascending=False)
+
+
+def clients_per_month(df):
+    """Number of distinct clients invoiced in each month, for every month at once."""
+    months = df["Invoice Date"].dt.to_period("M").rename("Month")
+    return df.groupby(months)["Client"].nunique().rename("Clients")
+
+
+def clients_in_month(df, year, month):
+    return int(clients_per_month(df).get(pd.Period(year=year, month=month, freq="M"), 0))
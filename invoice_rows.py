@@ -0,0 +1,96 @@
+import sys
+from dataclasses import dataclass
+
+# Compact row types for the invoice list and its line item / payment exports.
+# Child rows keep a reference to their InvoiceRow instead of copying the
+# invoice's fields, and repeated values (client names, statuses, payment
+# types) are interned so every row shares one string object.
+
+LINE_ITEM_COLUMNS = [
+    "Invoice Number", "Client", "Street", "City", "State", "Zipcode", "Email",
+    "Invoice Total", "Status", "Due Date", "Invoice Date", "Line Item Description",
+    "Line Item Total", "Work Title", "Work Type", "Work URL"
+]
+PAYMENT_COLUMNS = [
+    "Invoice Number", "Client", "Street", "City", "State", "Zipcode", "Email",
+    "Invoice Total", "Status", "Due Date", "Invoice Date", "Payment Date",
+    "Payment Amount", "Payment Type", "Payment Key", "Payment Method"
+]
+
+WORK_URL = "https://app2.karbonhq.com/YtfB1S5FYHG#/work/{}/tasks"
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@dataclass(slots=True)
+class InvoiceRow:
+    """One invoice in the local store; fields are in invoice_store.INVOICE_COLUMNS order."""
+    client: str
+    number: str
+    total: float
+    street: str
+    city: str
+    state: str
+    zip: str
+    status: str
+    due_date: str
+    invoice_date: str
+    key: str
+    email: str
+
+    def __post_init__(self):
+        self.client = _intern(self.client)
+        self.status = _intern(self.status)
+
+    def values(self):
+        return (self.client, self.number, self.total, self.street, self.city, self.state,
+                self.zip, self.status, self.due_date, self.invoice_date, self.key, self.email)
+
+    def export_values(self):
+        # the invoice columns shared by the line item and payment exports
+        return (self.number, self.client, self.street, self.city, self.state, self.zip,
+                self.email, self.total, self.status, self.due_date, self.invoice_date)
+
+
+@dataclass(slots=True)
+class LineItemRow:
+    """A row of the line item export, in LINE_ITEM_COLUMNS order."""
+    invoice: InvoiceRow
+    description: str
+    total: float
+    work_key: str | None = None         # None for line items not billed from a work item
+    work_title: str = ""
+    work_type: str = ""
+
+    def __post_init__(self):
+        self.work_type = _intern(self.work_type)
+
+    def values(self):
+        work_url = WORK_URL.format(self.work_key) if self.work_key is not None else ""
+        return (*self.invoice.export_values(), self.description, self.total,
+                self.work_title, self.work_type, work_url)
+
+
+@dataclass(slots=True)
+class PaymentRow:
+    """A row of the payment export, in PAYMENT_COLUMNS order.
+
+    `invoice` may be filled in later, e.g. when payments are listed before
+    the invoices they belong to.
+    """
+    invoice: InvoiceRow | None
+    payment_date: str
+    amount: float
+    payment_type: str
+    payment_key: str
+    payment_method: str
+
+    def __post_init__(self):
+        self.payment_type = _intern(self.payment_type)
+        self.payment_method = _intern(self.payment_method)
+
+    def values(self):
+        return (*self.invoice.export_values(), self.payment_date, self.amount,
+                self.payment_type, self.payment_key, self.payment_method)
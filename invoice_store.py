@@ -0,0 +1,175 @@
+import math
+import os
+import sqlite3
+import pandas as pd
+from invoice_rows import InvoiceRow
+
+# Typed local copy of the invoice list shared by every stage of get_all_invoices.
+# invoices.csv is still written, but only as an export.
+STORE_FILE = "karbon.db"
+CSV_FILE = "invoices.csv"
+
+# column -> SQLite type, in export order (and InvoiceRow field order)
+INVOICE_COLUMNS = {
+    "Client": "TEXT",
+    "Invoice Number": "TEXT",
+    "Invoice Total": "REAL",
+    "Street": "TEXT",
+    "City": "TEXT",
+    "State": "TEXT",
+    "Zip": "TEXT",
+    "Status": "TEXT",
+    "Due Date": "DATE",
+    "Invoice Date": "DATE",
+    "Invoice Key": "TEXT PRIMARY KEY",
+    "Email Address": "TEXT"
+}
+# same order as the invoice listing in get_all_invoices
+ORDER_BY = 'ORDER BY "Invoice Date", "Invoice Key"'
+DATE_COLUMNS = [col for col, sql_type in INVOICE_COLUMNS.items() if sql_type == "DATE"]
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def store_exists(path=STORE_FILE):
+    return os.path.exists(path)
+
+
+def _value(value):
+    # SQLite has no NaN; store blanks and missing values as NULL
+    if value is None or value == "" or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+
+def _create_table(conn, table):
+    column_defs = ", ".join(f"{_quote(c)} {t}" for c, t in INVOICE_COLUMNS.items())
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.execute(f"CREATE TABLE {table} ({column_defs})")
+
+
+class InvoiceWriter:
+    """Stream invoice rows into a fresh copy of the invoices table.
+
+    Rows are committed every `batch_size` rows. The new table only replaces
+    the stored invoice list when the writer is closed without an error, so
+    a failed run leaves the previous list intact.
+    """
+
+    def __init__(self, path=STORE_FILE, batch_size=500):
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self._batch = []
+        self._conn = sqlite3.connect(path)
+        _create_table(self._conn, "invoices_new")
+        placeholders = ", ".join("?" for _ in INVOICE_COLUMNS)
+        self._insert = f"INSERT INTO invoices_new VALUES ({placeholders})"
+
+    def write(self, row):
+        self._batch.append(tuple(_value(v) for v in row.values()))
+        self.rows_written += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        self._conn.executemany(self._insert, self._batch)
+        self._conn.commit()
+        self._batch = []
+
+    def close(self, replace=True):
+        try:
+            if replace:
+                self.flush()
+                self._conn.execute("DROP TABLE IF EXISTS invoices")
+                self._conn.execute("ALTER TABLE invoices_new RENAME TO invoices")
+                self._conn.execute('CREATE INDEX idx_invoices_date ON invoices ("Invoice Date")')
+            else:
+                self._conn.execute("DROP TABLE IF EXISTS invoices_new")
+            self._conn.commit()
+        finally:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(replace=exc_type is None)
+
+
+def save_invoices(df, path=STORE_FILE):
+    """Replace the stored invoice list with `df`."""
+    values = df.reindex(columns=list(INVOICE_COLUMNS)).itertuples(index=False, name=None)
+    with InvoiceWriter(path) as writer:
+        writer.write_many(InvoiceRow(*row) for row in values)
+
+
+def upsert_invoices(rows, path=STORE_FILE):
+    """Insert new invoices and replace existing ones with the same Invoice Key."""
+    placeholders = ", ".join("?" for _ in INVOICE_COLUMNS)
+    values = (tuple(_value(v) for v in row.values()) for row in rows)
+    with sqlite3.connect(path) as conn:
+        conn.executemany(f"INSERT OR REPLACE INTO invoices VALUES ({placeholders})", values)
+    conn.close()
+
+
+def load_invoices(columns=None, parse_dates=True, path=STORE_FILE):
+    """Load invoices in listing order, optionally only the given columns.
+
+    Date columns come back as datetimes unless `parse_dates` is False, in
+    which case they stay as YYYY-MM-DD strings for exporting.
+    """
+    if not store_exists(path):
+        import_csv(path=path)
+
+    columns = list(columns or INVOICE_COLUMNS)
+    select = ", ".join(_quote(c) for c in columns)
+    dates = [c for c in DATE_COLUMNS if c in columns] if parse_dates else None
+    with sqlite3.connect(path) as conn:
+        df = pd.read_sql_query(f"SELECT {select} FROM invoices {ORDER_BY}", conn,
+                               parse_dates=dates)
+    conn.close()
+    return df
+
+
+def load_invoice_rows(path=STORE_FILE):
+    """Load invoices in listing order as InvoiceRows, dates as YYYY-MM-DD text.
+
+    Reads straight from SQLite, without building a DataFrame, for the
+    exports that walk the list one invoice at a time.
+    """
+    if not store_exists(path):
+        import_csv(path=path)
+
+    select = ", ".join(_quote(c) for c in INVOICE_COLUMNS)
+    with sqlite3.connect(path) as conn:
+        rows = [InvoiceRow(*values) for values in conn.execute(f"SELECT {select} FROM invoices {ORDER_BY}")]
+    conn.close()
+    return rows
+
+
+def import_csv(csv_path=CSV_FILE, path=STORE_FILE):
+    """Build the store from an invoices.csv written by an older run."""
+    if not os.path.exists(csv_path):
+        raise FileNotFoundError("No invoice store found; generate the base invoice list first.")
+    print(f"Importing '{csv_path}' into '{path}'...")
+    df = pd.read_csv(csv_path, encoding="utf-8-sig", dtype=str, keep_default_na=False)
+    df["Invoice Total"] = pd.to_numeric(df["Invoice Total"], errors="coerce")
+    save_invoices(df, path)
+
+
+def export_csv(filename=CSV_FILE, path=STORE_FILE, chunksize=5000):
+    """Write the stored invoice list to CSV a chunk at a time."""
+    select = ", ".join(_quote(c) for c in INVOICE_COLUMNS)
+    with sqlite3.connect(path) as conn:
+        chunks = pd.read_sql_query(f"SELECT {select} FROM invoices {ORDER_BY}", conn,
+                                   chunksize=chunksize)
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(filename, mode="w" if i == 0 else "a", header=i == 0,
+                         index=False, encoding="utf-8")
+    conn.close()
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+
+
+class TTLCache:
+    """In-memory key/value cache that can be saved to a JSON file.
+
+    Entries older than `ttl` seconds are treated as missing, both in memory
+    and when the file is loaded on a later run.
+    """
+
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = {}                    # key -> [saved_at, value]
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    def _fresh(self, saved_at):
+        return self.ttl is None or time.time() - saved_at < self.ttl
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            print(f"Ignoring unreadable cache file '{self.path}'")
+            return
+        with self._lock:
+            self._data = {k: v for k, v in stored.items() if self._fresh(v[0])}
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            snapshot = {k: v for k, v in self._data.items() if self._fresh(v[0])}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self._fresh(entry[0]):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = [time.time(), value]
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached value for `key`, calling `fetch(key)` on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = fetch(key)
+            self.set(key, value)
+        return value
+
+    def __len__(self):
+        return len(self._data)
+
+    def summary(self, name):
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100) if total else 0.0
+        return f"{name} cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
@@ -0,0 +1,356 @@
+import http.client
+import os
+import queue
+import random
+import threading
+import time
+import urllib.parse
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+import karbon_json
+import karbon_metrics
+
+# Overridden with karbon_api_url, e.g. to point the scripts at the benchmark mock server
+API_URL = "https://api.karbonhq.com"
+
+# Requests per second to start at; the throttler backs off from here on 429s.
+# karbon_rate_limit / karbon_max_retries are read when a client is created,
+# so values loaded from .env after this module is imported still apply.
+RATE_LIMIT = 10.0
+MAX_RETRIES = 5
+
+# pages read ahead by pages()/paginate() for exports that pass prefetch=PREFETCH_PAGES
+PREFETCH_PAGES = 2
+
+# responses worth retrying: rate limited or a transient server error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# characters left as-is when quoting paths and OData query strings
+_SAFE_URL_CHARS = "/?&=$,;:@!'()*+%~"
+
+
+class KarbonAPIError(Exception):
+    """Raised when the API returns an error response after all retries."""
+
+    def __init__(self, method, url, status, reason, body=b""):
+        self.method = method
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.body = body
+        detail = body.decode("utf-8", "replace")[:500]
+        super().__init__(f"{method} {url} -> {status} {reason}: {detail}")
+
+
+class KarbonResponse(namedtuple("KarbonResponse", "status reason body headers")):
+    """Status line, headers and raw body bytes of a Karbon API response."""
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def json(self):
+        # parsed straight from the body bytes; no decoded str copy with orjson
+        return karbon_json.loads(self.body)
+
+    def retry_after(self):
+        """Seconds requested by a Retry-After header, or None."""
+        value = self.headers.get("Retry-After") if self.headers else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class Throttler:
+    """Adaptive token bucket shared by every thread using a client.
+
+    Each request takes one token. A 429 halves the refill rate and pauses
+    all callers for the Retry-After period; successful requests raise the
+    rate again in steps of `step` times the starting rate, so a pool of
+    workers settles just under the API quota instead of repeatedly tripping
+    it. The 429s of one throttling event (every request in flight when the
+    quota tripped) count as a single cut.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, min_rate=0.5, step=0.02):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.step = step * rate
+        self._tokens = 1.0
+        # the time the token balance is valid at; in the future during a pause
+        self._updated = time.monotonic()
+        self._cut_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(1.0, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # a negative balance reserves a slot in the queue of waiting callers,
+            # which starts when the current pause (if any) ends
+            self._tokens -= 1.0
+            wait = self._updated - now + max(-self._tokens / self.rate, 0.0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+    def on_throttled(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._updated = max(self._updated, now + retry_after)
+            if now >= self._cut_until:
+                self.rate = max(self.min_rate, self.rate / 2)
+                # later 429s from requests already in flight belong to this cut
+                self._cut_until = self._updated + 1 / self.rate
+
+
+def odata_string(value):
+    """Quote `value` as an OData string literal: O'Brien -> 'O''Brien'."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+class BatchLookup:
+    """Fetch records by key with `$filter=<field> in (...)`, `batch_size` keys per request.
+
+    `list_records(odata_filter)` returns the records matching a filter and
+    `get_record(key)` one record, or an empty dict if it does not exist. If
+    the API rejects the `in` filter with a 400, batching is switched off and
+    every later key is fetched with `get_record`.
+    """
+
+    def __init__(self, name, field, list_records, get_record, batch_size=50):
+        self.name = name
+        self.field = field
+        self.list_records = list_records
+        self.get_record = get_record
+        self.batch_size = batch_size
+        self.batched = True
+
+    def __call__(self, keys):
+        """Yield the records found for `keys`; keys without a record are skipped."""
+        keys = list(keys)
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            if self.batched:
+                quoted = ",".join(odata_string(key) for key in batch)
+                try:
+                    yield from self.list_records(f"{self.field} in ({quoted})")
+                    continue
+                except KarbonAPIError as exc:
+                    if exc.status != 400:
+                        raise
+                    print(f"{self.name} $filter batch lookups are not supported, "
+                          f"falling back to one request per key.")
+                    self.batched = False
+
+            for key in batch:
+                record = self.get_record(key)
+                if record:
+                    yield record
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Exponential backoff with jitter for the given retry attempt (0-based)."""
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class KarbonClient:
+    """Shared transport for the Karbon v3 API.
+
+    Each thread that uses the client gets its own keep-alive HTTPS
+    connection, so a pool of workers pays for one TLS handshake per worker
+    rather than one per request. Plain http:// base URLs are accepted for
+    local mock servers.
+    """
+
+    def __init__(self, bearer_token=None, access_key=None, base_url=None, timeout=60,
+                 throttler=None, max_retries=None, metrics=None):
+        parts = urllib.parse.urlsplit(base_url or os.getenv("karbon_api_url") or API_URL)
+        self.host = parts.netloc
+        self._connection_class = (http.client.HTTPConnection if parts.scheme == "http"
+                                  else http.client.HTTPSConnection)
+        self.timeout = timeout
+        self.throttler = throttler or Throttler(float(os.getenv("karbon_rate_limit", RATE_LIMIT)))
+        self.metrics = metrics or karbon_metrics.metrics
+        self.max_retries = (int(os.getenv("karbon_max_retries", MAX_RETRIES))
+                            if max_retries is None else max_retries)
+        self.headers = {
+            "Accept": "application/json",
+            "Authorization": bearer_token or os.getenv("bearer_token"),
+            "AccessKey": access_key or os.getenv("access_key")
+        }
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connection_class(self.host, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _reset_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def _path(self, url):
+        # @odata.nextLink values are absolute URLs; only the path and query are sent
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        return urllib.parse.quote(path, safe=_SAFE_URL_CHARS)
+
+    def _send(self, method, path, body, headers):
+        conn = self._connection()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            res = conn.getresponse()
+            return KarbonResponse(res.status, res.reason, res.read(), res.headers)
+        except (OSError, http.client.HTTPException):
+            # covers idle keep-alive connections closed by the server
+            self._reset_connection()
+            raise
+
+    def request(self, method, url, body=None):
+        """Send a request, retrying rate-limited, 5xx and dropped requests.
+
+        The last response is returned once retries run out, so callers can
+        still inspect the status.
+        """
+        path = self._path(url)
+        headers = dict(self.headers)
+        if body is not None:
+            body = karbon_json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        for attempt in range(self.max_retries + 1):
+            self.throttler.acquire()
+            started = time.time()
+            try:
+                res = self._send(method, path, body, headers)
+            except (OSError, http.client.HTTPException) as exc:
+                if attempt == self.max_retries:
+                    self.metrics.record(method, path, None, time.time() - started, 0, attempt, started)
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"  {method} {path} failed ({exc!r}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            latency = time.time() - started
+
+            if res.status not in RETRY_STATUSES:
+                self.throttler.on_success()
+                self.metrics.record(method, path, res.status, latency, len(res.body), attempt, started)
+                return res
+
+            retry_after = res.retry_after()
+            if res.status == 429:
+                self.throttler.on_throttled(retry_after)
+            if attempt == self.max_retries:
+                self.metrics.record(method, path, res.status, latency, len(res.body), attempt, started)
+                return res
+            delay = max(retry_after or 0.0, backoff_delay(attempt))
+            print(f"  {method} {path} -> {res.status}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def get(self, url):
+        return self.request("GET", url)
+
+    def get_json(self, url, missing_ok=False):
+        """Return the decoded body of a GET, raising KarbonAPIError on failure.
+
+        With `missing_ok`, a 404 returns an empty dict instead.
+        """
+        res = self.get(url)
+        if missing_ok and res.status == 404:
+            return {}
+        if not res.ok:
+            raise KarbonAPIError("GET", url, res.status, res.reason, res.body)
+        return res.json()
+
+    def put_json(self, url, payload):
+        return self.request("PUT", url, body=payload)
+
+    def pages(self, url, prefetch=0):
+        """Yield each page of a collection, following @odata.nextLink.
+
+        With `prefetch`, a background thread requests and decodes up to that
+        many pages ahead while the caller is still working on the current one.
+        """
+        if prefetch:
+            yield from self._prefetched_pages(url, prefetch)
+            return
+        while url:
+            data = self.get_json(url)
+            yield data
+            url = data.get("@odata.nextLink")
+
+    def _prefetched_pages(self, url, depth):
+        pages = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+
+        def put(item):
+            # stop waiting for room once the caller has stopped reading
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch(url):
+            try:
+                for data in self.pages(url):
+                    if not put((data, None)):
+                        return
+                put((None, None))
+            except Exception as exc:
+                put((None, exc))
+            finally:
+                self._reset_connection()
+
+        thread = threading.Thread(target=self.metrics.bind_stage(fetch), args=(url,), daemon=True)
+        thread.start()
+        try:
+            while True:
+                data, exc = pages.get()
+                if exc is not None:
+                    raise exc
+                if data is None:
+                    return
+                yield data
+        finally:
+            stop.set()
+
+    def paginate(self, url, prefetch=0):
+        """Yield every record of a collection across all of its pages.
+
+        Records are yielded as each page arrives, so an export can write one
+        page while the next is fetched (in the background with `prefetch`).
+        """
+        for page in self.pages(url, prefetch):
+            yield from page.get("value", [])
+
+    def close(self):
+        self._reset_connection()
@@ -0,0 +1,147 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Set karbon_trace_file in .env to also dump every request as JSON lines
+TRACE_FILE_ENV = "karbon_trace_file"
+
+RequestRecord = namedtuple(
+    "RequestRecord", "stage method endpoint status latency bytes retries started"
+)
+
+_KEY_SEGMENT = re.compile(r"^(/v\d+/[^/?]+)/[^?]+")
+_EXPAND = re.compile(r"[?&]\$expand=([^&]+)")
+
+
+def endpoint_template(path):
+    """Group request paths by endpoint: /v3/WorkItems/abc -> /v3/WorkItems/{key}."""
+    template = _KEY_SEGMENT.sub(r"\1/{key}", path.split("?", 1)[0])
+    expand = _EXPAND.search(path)
+    return f"{template}?$expand={expand.group(1)}" if expand else template
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class RequestMetrics:
+    """Per-request timings, grouped by the pipeline stage that made them.
+
+    The stage is tracked per thread. Worker pools made with `stage_pool`
+    inherit the stage of the thread that created them, so requests sent
+    from a stage's workers are counted under that stage.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.caches = {}
+        self._stage_times = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def current_stage(self):
+        return getattr(self._local, "stage", "main")
+
+    def _set_stage(self, name):
+        self._local.stage = name
+
+    @contextmanager
+    def stage(self, name):
+        previous = self.current_stage()
+        self._set_stage(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._set_stage(previous)
+            with self._lock:
+                self._stage_times[name] = time.perf_counter() - started
+
+    def stage_pool(self, max_workers):
+        """ThreadPoolExecutor whose workers report under the current stage."""
+        return ThreadPoolExecutor(max_workers=max_workers, initializer=self._set_stage,
+                                  initargs=(self.current_stage(),))
+
+    def bind_stage(self, func):
+        """Wrap `func` so a thread running it reports under the current stage."""
+        stage = self.current_stage()
+
+        def run(*args, **kwargs):
+            self._set_stage(stage)
+            return func(*args, **kwargs)
+        return run
+
+    def record(self, method, path, status, latency, nbytes, retries, started):
+        record = RequestRecord(self.current_stage(), method, endpoint_template(path),
+                               status, latency, nbytes, retries, started)
+        with self._lock:
+            self.records.append(record)
+
+    def register_cache(self, name, cache):
+        # a karbon_cache.TTLCache; its hit rate is included in the report
+        self.caches[name] = cache
+
+    def report(self, top=5):
+        if not self.records:
+            return "No API requests were made."
+
+        by_stage = defaultdict(list)
+        for record in self.records:
+            by_stage[record.stage].append(record)
+
+        lines = ["", "API request summary"]
+        for stage, records in by_stage.items():
+            latencies = sorted(r.latency for r in records)
+            elapsed = self._stage_times.get(stage) or (
+                max(r.started + r.latency for r in records) - min(r.started for r in records)
+            )
+            errors = sum(1 for r in records if r.status is None or r.status >= 400)
+            lines.append(
+                f"  {stage}: {len(records)} requests in {elapsed:.1f}s "
+                f"({len(records) / elapsed if elapsed else 0:.1f} req/s), "
+                f"latency p50 {percentile(latencies, 50) * 1000:.0f}ms / "
+                f"p95 {percentile(latencies, 95) * 1000:.0f}ms / "
+                f"p99 {percentile(latencies, 99) * 1000:.0f}ms, "
+                f"{sum(r.retries for r in records)} retries, {errors} errors, "
+                f"{sum(r.bytes for r in records) / 1_000_000:.1f} MB"
+            )
+
+        by_endpoint = defaultdict(list)
+        for record in self.records:
+            by_endpoint[(record.method, record.endpoint)].append(record.latency)
+        lines.append("  slowest endpoints (total time):")
+        ranked = sorted(by_endpoint.items(), key=lambda item: sum(item[1]), reverse=True)
+        for (method, endpoint), latencies in ranked[:top]:
+            latencies.sort()
+            lines.append(f"    {method} {endpoint}: {len(latencies)} requests, {sum(latencies):.1f}s total, "
+                         f"p95 {percentile(latencies, 95) * 1000:.0f}ms")
+
+        for name, cache in self.caches.items():
+            lines.append(f"  {cache.summary(name)}")
+        return "\n".join(lines)
+
+    def dump_trace(self, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            for record in self.records:
+                f.write(json.dumps(record._asdict()) + "\n")
+        print(f"Request trace written to '{filename}'.")
+
+    def finish(self):
+        """Print the summary, and dump the trace if karbon_trace_file is set."""
+        print(self.report())
+        trace_file = os.getenv(TRACE_FILE_ENV)
+        if trace_file:
+            self.dump_trace(trace_file)
+
+
+# shared by every KarbonClient in the process
+metrics = RequestMetrics()
@@ -1,21 +1,108 @@
-import http.client
-import os
 from dotenv import load_dotenv
+import argparse
+import http.client
 import json
+import os
 import pandas as pd
 import re
+import threading
+from collections import Counter
+from functools import partial, wraps
+from karbon_cache import TTLCache
+from karbon_client import KarbonAPIError, KarbonClient
+from karbon_metrics import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 
-conn = http.client.HTTPSConnection("api.karbonhq.com")
-payload = ''
-headers = {
-    'Accept': 'application/json',
-    'Authorization': os.getenv("bearer_token"),
-    'AccessKey': os.getenv("access_key")
+api = KarbonClient()
+
+# Number of organizations updated concurrently
+MAX_WORKERS = int(os.getenv("max_workers", "8"))
+
+# Custom field definitions (/v3/CustomFields) are cached on disk for a day
+CUSTOM_FIELD_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "custom_fields_cache.json")
+CUSTOM_FIELD_CACHE_TTL = 24 * 3600  # seconds
+
+# errors that fail a single organization instead of the whole run
+REQUEST_ERRORS = (KarbonAPIError, OSError, http.client.HTTPException)
+
+# custom_fields_to_update.csv column -> name of the custom field it is written to
+CSV_FIELDS = {
+    # "Back Up Method": "Backup Method",
+    "Entity Type": "Entity Type"
 }
 
+class CustomFieldError(ValueError):
+    """A custom field value that Karbon would reject."""
+
+class CustomFieldRegistry:
+    """Custom field definitions by name, loaded once per run.
+
+    Definitions come from /v3/CustomFields, or from the on-disk cache while
+    it is fresh. Values are checked against the field's type and option
+    list before anything is sent.
+    """
+
+    def __init__(self, path=CUSTOM_FIELD_CACHE_FILE, ttl=CUSTOM_FIELD_CACHE_TTL):
+        self._cache = TTLCache(path, ttl=ttl)
+        metrics.register_cache("Custom field", self._cache)
+        self._by_name = None
+        self._lock = threading.Lock()
+
+    def definitions(self) -> dict[str, dict]:
+        with self._lock:
+            if self._by_name is None:
+                fields = self._cache.get_or_fetch("CustomFields", self._fetch)
+                self._cache.save()
+                self._by_name = {cf["Name"]: cf for cf in fields}
+        return self._by_name
+
+    @staticmethod
+    def _fetch(_):
+        return list(api.paginate("/v3/CustomFields"))
+
+    def get(self, name: str) -> dict:
+        definition = self.definitions().get(name)
+        if definition is None:
+            raise CustomFieldError(f"no custom field named '{name}'")
+        return definition
+
+    def options(self, name: str) -> list[str]:
+        options = self.get(name).get("Options") or []
+        return [o.get("Value", o.get("Name")) if isinstance(o, dict) else o for o in options]
+
+    def field_value(self, name: str, value) -> dict:
+        """Build a CustomFieldValues entry for `name`, validating `value` first."""
+        definition = self.get(name)
+        values = value if isinstance(value, list) else [value]     # ← must be a list
+        cf_type = definition.get("Type", "")
+
+        if cf_type == "ListSingleSelect" and len(values) != 1:
+            raise CustomFieldError(f"'{name}' takes exactly one value, got {len(values)}")
+        options = self.options(name)
+        if cf_type.startswith("List") and options:
+            invalid = [v for v in values if v not in options]
+            if invalid:
+                raise CustomFieldError(f"{invalid} not allowed for '{name}' (options: {options})")
+
+        return {"Key": definition["Key"], "Name": name, "Type": cf_type, "Value": values}
+
+registry = CustomFieldRegistry()
+
+def build_field_values(label: str, wanted: dict) -> list[dict]:
+    """Turn {field name: value} into validated CustomFieldValues entries.
+
+    Invalid values are reported and dropped so they never reach a PUT.
+    """
+    entries = []
+    for name, value in wanted.items():
+        try:
+            entries.append(registry.field_value(name, value))
+        except CustomFieldError as exc:
+            print(f"{label}: skipping {exc}")
+    return entries
+
 # one regex per label, anchored to “start of line” to avoid false matches
 _PATTERNS = {
     "accounting_software": re.compile(
@@ -29,10 +116,17 @@ _PATTERNS = {
     ),
 }
 
+# _PATTERNS label -> name of the custom field it fills
+DESCRIPTION_FIELDS = {
+    "admin_password": "QB Admin Password",
+    "accounting_software": "Accounting Software",
+    "ras_id": "RAS ID",
+}
+DEFAULT_DESCRIPTION_FIELDS = tuple(DESCRIPTION_FIELDS)
+
 def get_description(org_key: str) -> str:
-    conn.request("GET", f"/v3/Organizations/{org_key}", headers=headers)
-    res  = conn.getresponse()
-    body = res.read()
+    res  = api.get(f"/v3/Organizations/{org_key}")
+    body = res.body
 
     # ----- 1) non‑200 means org is missing or forbidden -------------------
     if res.status != 200:
@@ -46,7 +140,7 @@ def get_description(org_key: str) -> str:
 
     # ----- 3) decode JSON safely -----------------------------------------
     try:
-        resp_json = json.loads(body.decode("utf‑8"))
+        resp_json = res.json()
     except json.JSONDecodeError:
         print(f"  ⚠️  {org_key}: invalid JSON in response")
         return ""
@@ -60,24 +154,10 @@ def get_description(org_key: str) -> str:
     return text
 
 def list_custom_fields():
-    conn.request("GET", f"/v3/CustomFields", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-    resp_json = json.loads(data.decode("utf-8"))
-    cf_keys = []
-    cf_names = []
-    for cf in resp_json["value"]:
-        cf_keys.append(cf["Key"])
-        cf_names.append(cf["Name"])
-    cf_mp = dict(zip(cf_names, cf_keys))
-    return cf_mp
+    return {name: cf["Key"] for name, cf in registry.definitions().items()}
 
 def get_custom_fields(org_key):
-    conn.request("GET", f"/v3/CustomFieldValues/{org_key}", payload, headers)
-    res = conn.getresponse()
-    data = res.read()
-    resp_json = json.loads(data.decode("utf-8"))
-    return resp_json
+    return api.get_json(f"/v3/CustomFieldValues/{org_key}")
 
 def extract_cf_from_description(description: str) -> dict[str, str | None]:
     out = {}
@@ -96,198 +176,214 @@ def get_cf_value(data:dict, cf_name:str):
             return cf.get("Value")
     return None
 
-def update_qb_admin_password(org_key):
-    # 1. Get current value
-    current = get_cf_value(get_custom_fields(org_key), "QB Admin Password")
-    if current:                      # already set → bail out
-        print(f"Field already populated: {current}")
-        return
-
-    # 2. Pull it from the description
-    description  = get_description(org_key)
-    if description is None:
-        print(f"No description found for {org_key}")
-        return
-    new_pw       = extract_cf_from_description(description).get("admin_password")
-    if not new_pw:
-        print("No QB Admin Password found in description")
-        return
-
-    # 3. Build Karbon‑compliant payload
-    payload = {
-        "EntityKey": org_key,
-        "CustomFieldValues": [
-            {
-                "Key":   "bT3FHvnxFCg",          # key of the CF definition
-                "Name":  "QB Admin Password",
-                "Type":  "Text",
-                "Value": [new_pw]                # ← must be a list
-            }
-        ]
-    }
-    body = json.dumps(payload).encode("utf-8")   # bytes
-    headers["Content-Type"] = "application/json" # add/overwrite
-
-    # 4. Send request
-    conn.request("PUT",
-                 f"/v3/CustomFieldValues/{org_key}",
-                 body=body,
-                 headers=headers)
-
-    res = conn.getresponse()
-    print(f"Update status: {res.status} {res.reason}")
-    print(res.read().decode())
-        
-def update_accounting_software(org_key):
-    ## NOTE this does not work because this field is limited to 4 values
-    # 1. Get current value
-    current = get_cf_value(get_custom_fields(org_key), "Accounting Software")
-    if current:                      # already set → bail out
-        print(f"Field already populated: {current}")
-        return
-
-    # 2. Pull it from the description
-    description  = get_description(org_key)
-    if description is None:
-        print(f"No description found for {org_key}")
-        return
-    new_pw       = extract_cf_from_description(description).get("accounting_software")
-    if not new_pw:
-        print("No Accounting Software found in description")
-        return
-
-    # 3. Build Karbon‑compliant payload
-    payload = {
-        "EntityKey": org_key,
-        "CustomFieldValues": [
-            {
-                "Key":   "36yxh2LSmwRY",          # key of the CF definition
-                "Name":  "Accounting Software",
-                "Type":  "Text",
-                "Value": [new_pw]                # ← must be a list
-            }
-        ]
-    }
-    body = json.dumps(payload).encode("utf-8")   # bytes
-    headers["Content-Type"] = "application/json" # add/overwrite
-
-    # 4. Send request
-    conn.request("PUT",
-                 f"/v3/CustomFieldValues/{org_key}",
-                 body=body,
-                 headers=headers)
-
-    res = conn.getresponse()
-    print(f"Update status: {res.status} {res.reason}")
-    print(res.read().decode())
-
-def update_ras_id(org_key):
-    # 1. Get current value
-    current = get_cf_value(get_custom_fields(org_key), "RAS ID")
-    if current:                      # already set → bail out
-        print(f"Field already populated: {current}")
-        return
-
-    # 2. Pull it from the description
-    description  = get_description(org_key)
-    if description is None:
-        print(f"No description found for {org_key}")
-        return
-    new_pw       = extract_cf_from_description(description).get("ras_id")
-    if not new_pw:
-        print("No RAS ID found in description")
-        return
-
-    # 3. Build Karbon‑compliant payload
-    payload = {
-        "EntityKey": org_key,
-        "CustomFieldValues": [
-            {
-                "Key":   "3gBCy74scz6T",          # key of the CF definition
-                "Name":  "RAS ID",
-                "Type":  "Text",
-                "Value": [new_pw]                # ← must be a list
-            }
-        ]
-    }
-    body = json.dumps(payload).encode("utf-8")   # bytes
-    headers["Content-Type"] = "application/json" # add/overwrite
-
-    # 4. Send request
-    conn.request("PUT",
-                 f"/v3/CustomFieldValues/{org_key}",
-                 body=body,
-                 headers=headers)
-
-    res = conn.getresponse()
-    print(f"Update status: {res.status} {res.reason}")
-    print(res.read().decode())
-
-def update_from_csv(org_name, org_key):
-    # get values from csv
-    df = pd.read_csv("custom_fields_to_update.csv", encoding="utf-8-sig")
-    match = df[df["Account Name"] == org_name]
-
-    if match.empty:
-        return None
-    
-    fields = ['Entity Type', 'Back Up Method', 'Closing Date Password']
-    
-    entity_type = match['Entity Type'].iloc[0]
-    backup_method = match['Back Up Method'].iloc[0]
-
-    #build payload
-    payload = {
+def as_value_list(value) -> list:
+    if value is None:
+        return []
+    return [str(v) for v in value] if isinstance(value, list) else [str(value)]
+
+def changed_fields(current: dict, updates: list[dict]) -> list[dict]:
+    """Keep only the field updates whose value differs from what Karbon has now."""
+    return [
+        cf for cf in updates
+        if as_value_list(get_cf_value(current, cf["Name"])) != as_value_list(cf["Value"])
+    ]
+
+def plan_entry(org_name, org_key, current, updates, source) -> dict:
+    # one line of a plan file: the PUT body plus a readable before/after diff
+    return {
         "EntityKey": org_key,
-        "CustomFieldValues": [
-            # {
-            #     "Key":   "DRrWHybmW1V", 
-            #     "Name":  "Backup Method",
-            #     "Type":  "Text",
-            #     "Value": [backup_method]
-            # },
-            {
-                "Key":   "fb94WsjszXM", 
-                "Name":  "Entity Type",
-                "Type":  "ListSingleSelect",
-                "Value": [entity_type]
-            }
-        ]
+        "Name": org_name,
+        "Source": source,
+        "CustomFieldValues": updates,
+        "Changes": {
+            cf["Name"]: {"from": get_cf_value(current, cf["Name"]), "to": cf["Value"]}
+            for cf in updates
+        }
     }
 
-    # send request
-    body = json.dumps(payload).encode("utf-8")
-    headers["Content-Type"] = "application/json"
-
-    conn.request("PUT",
-                 f"/v3/CustomFieldValues/{org_key}",
-                 body=body,
-                 headers=headers)
-    
-    res = conn.getresponse()
-    print(f"Update status: {res.status} {res.reason}")
-    print(res.read().decode())
-
-def main():
-    df = pd.read_csv("organizations.csv", encoding="utf-8-sig")
-
-    for _, row in df.iterrows():                # loop through every row
-        org_key  = row["Key"]
-        org_name = row["Name"]
+def fails_per_org(plan):
+    """Report an org whose requests fail as ("failed", None) and carry on with the rest."""
+    @wraps(plan)
+    def wrapper(org_name, org_key, *args, **kwargs):
+        try:
+            return plan(org_name, org_key, *args, **kwargs)
+        except REQUEST_ERRORS as exc:
+            print(f"{org_name}: failed ({exc})")
+            return "failed", None
+    return wrapper
+
+@fails_per_org
+def plan_from_description(org_name, org_key, fields=DEFAULT_DESCRIPTION_FIELDS):
+    """Work out which empty custom fields can be filled from the org description.
+
+    Returns (status, plan entry or None). The current values and the
+    description are each read once per org.
+    """
+    # 1. Get current values; populated fields are left alone
+    current = get_custom_fields(org_key)
+    empty = [f for f in fields if not get_cf_value(current, DESCRIPTION_FIELDS[f])]
+    if not empty:
+        print(f"{org_name}: fields already populated: {', '.join(DESCRIPTION_FIELDS[f] for f in fields)}")
+        return "unchanged", None
+
+    # 2. Pull them from the description
+    description = get_description(org_key)
+    if not description:
+        print(f"{org_name}: no description found")
+        return "no description", None
+    extracted = extract_cf_from_description(description)
+    found = {DESCRIPTION_FIELDS[f]: extracted[f] for f in empty if extracted.get(f)}
+    if not found:
+        print(f"{org_name}: no {', '.join(DESCRIPTION_FIELDS[f] for f in empty)} found in description")
+        return "no values", None
+
+    # values Karbon would reject (e.g. not one of a list field's options) are dropped here
+    updates = build_field_values(org_name, found)
+    if not updates:
+        return "no values", None
+    return "planned", plan_entry(org_name, org_key, current, updates, "description")
+
+def load_source_rows(filename="custom_fields_to_update.csv") -> dict[str, dict]:
+    # read once, indexed by account name (first row wins, as before)
+    df = pd.read_csv(filename, encoding="utf-8-sig", dtype=str, keep_default_na=False)
+    df = df.drop_duplicates("Account Name")
+    return df.set_index("Account Name").to_dict("index")
+
+@fails_per_org
+def plan_from_csv(org_name, org_key, source_rows):
+    """Work out which fields from custom_fields_to_update.csv differ for this org.
+
+    Returns (status, plan entry or None).
+    """
+    match = source_rows.get(org_name)
+    if match is None:
+        return "no match", None
+
+    # build the wanted values from the csv row
+    wanted = {name: match[column] for column, name in CSV_FIELDS.items() if match.get(column)}
+    updates = build_field_values(org_name, wanted)
+    if not updates:
+        return "no values", None
+
+    # only send fields that would actually change
+    current = get_custom_fields(org_key)
+    updates = changed_fields(current, updates)
+    if not updates:
+        print(f"{org_name}: already up to date")
+        return "unchanged", None
+    return "planned", plan_entry(org_name, org_key, current, updates, "csv")
+
+def apply_entry(entry) -> str:
+    # Build Karbon‑compliant payload and send it
+    org_key = entry["EntityKey"]
+    payload = {"EntityKey": org_key, "CustomFieldValues": entry["CustomFieldValues"]}
+    try:
+        res = api.put_json(f"/v3/CustomFieldValues/{org_key}", payload)
+    except REQUEST_ERRORS as exc:
+        print(f"{entry['Name']}: update failed ({exc})")
+        return "failed"
+
+    print(f"{entry['Name']}: update status {res.status} {res.reason} "
+          f"({', '.join(cf['Name'] for cf in entry['CustomFieldValues'])})")
+    if not res.ok:
+        print(f"{entry['Name']}: {res.body.decode()}")
+        return "failed"
+    return "updated"
+
+def update_from_description(org_key, fields=DEFAULT_DESCRIPTION_FIELDS):
+    """Fill empty custom fields from the org description with one PUT."""
+    status, entry = plan_from_description(org_key, org_key, fields)
+    return apply_entry(entry) if entry else status
 
-        if pd.isna(org_key):                    # skip blank keys, just in case
-            continue
+def update_qb_admin_password(org_key):
+    return update_from_description(org_key, ["admin_password"])
 
-        print(f"Updating → {org_name}  ({org_key})")
-        # update_qb_admin_password(org_key)
-        update_from_csv(org_name, org_key)
+def update_accounting_software(org_key):
+    ## NOTE this field is limited to 4 values; anything else is skipped by the registry
+    return update_from_description(org_key, ["accounting_software"])
 
-# print(list_custom_fields())
-main()
+def update_ras_id(org_key):
+    return update_from_description(org_key, ["ras_id"])
+
+def update_from_csv(org_name, org_key, source_rows):
+    status, entry = plan_from_csv(org_name, org_key, source_rows)
+    return apply_entry(entry) if entry else status
+
+def load_organizations(filename="organizations.csv"):
+    df = pd.read_csv(filename, encoding="utf-8-sig")
+    return df[df["Key"].notna()]                # skip blank keys, just in case
+
+def build_plan(source, workers=MAX_WORKERS) -> list[dict]:
+    """Read every org concurrently and return the plan entries, in org order."""
+    df = load_organizations()
+    if source == "csv":
+        plan_org = partial(plan_from_csv, source_rows=load_source_rows())
+    else:
+        plan_org = plan_from_description
+
+    print(f"Planning {len(df)} organizations from {source} with {workers} workers...")
+    with metrics.stage("plan"), metrics.stage_pool(workers) as executor:
+        results = list(executor.map(plan_org, df["Name"], df["Key"]))
+
+    print(", ".join(f"{count} {status}" for status, count in Counter(s for s, _ in results).items()))
+    return [entry for _, entry in results if entry]
+
+def write_plan(entries, filename):
+    with open(filename, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+
+    field_counts = Counter(name for entry in entries for name in entry["Changes"])
+    summary = ", ".join(f"{name}: {count}" for name, count in field_counts.items()) or "no changes"
+    print(f"Plan with {len(entries)} organizations written to '{filename}' ({summary}).")
+
+def read_plan(filename) -> list[dict]:
+    with open(filename, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def apply_plan(entries, workers=MAX_WORKERS):
+    print(f"Applying {len(entries)} updates with {workers} workers...")
+    with metrics.stage("apply"), metrics.stage_pool(workers) as executor:
+        results = list(executor.map(apply_entry, entries))
+    print(", ".join(f"{count} {status}" for status, count in Counter(results).items()) or "nothing to apply")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Backfill Karbon organization custom fields.",
+        epilog="Review a backfill with 'plan' (read-only), then send it with 'apply'. "
+               "'run' plans and applies in one go."
+    )
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="concurrent requests (default: max_workers from .env or 8)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_cmd = commands.add_parser("plan", help="compute the changes without sending anything")
+    plan_cmd.add_argument("--source", choices=["csv", "description"], default="csv",
+                          help="custom_fields_to_update.csv or labelled lines in org descriptions")
+    plan_cmd.add_argument("--out", default="custom_fields_plan.jsonl", help="plan file to write")
+
+    apply_cmd = commands.add_parser("apply", help="send the updates in a saved plan")
+    apply_cmd.add_argument("plan", help="plan file written by 'plan'")
+
+    run_cmd = commands.add_parser("run", help="plan and apply immediately")
+    run_cmd.add_argument("--source", choices=["csv", "description"], default="csv")
+
+    args = parser.parse_args(argv)
+    if args.command == "plan":
+        write_plan(build_plan(args.source, args.workers), args.out)
+    elif args.command == "apply":
+        apply_plan(read_plan(args.plan), args.workers)
+    else:
+        apply_plan(build_plan(args.source, args.workers), args.workers)
+    metrics.finish()
+
+if __name__ == "__main__":
+    main()
 
 ## Steps
 # get list of org keys from spreadsheet
 # for each key:
 # get the description
 # check if custom fields are empty
-# for each field, it empty, get value from description and update
\ No newline at end of file
+# for each field, it empty, get value from description and update